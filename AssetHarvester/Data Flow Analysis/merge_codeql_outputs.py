@@ -6,173 +6,209 @@ import os, sys
 import shutil
 import re
 import jellyfish
-import heapq
+import bisect
+import itertools
+import subprocess
 import yaml
 import xmltodict
+import io
+import threading
+from xml.parsers.expat import ExpatError
 import json
+import pyarrow as pa
+import pyarrow.dataset
 
 
-CODEQL_OUTPUT_DIR = 'CodeQL/Run Queries/CodeQL_Output'
-repo_list_df = pd.read_csv("repo-list.csv")
-repo_name_dict = repo_list_df.set_index('sanitized_repo_name')["repo_name"].to_dict()
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial, lru_cache
+# The results are read in the format run_codeql_queries.py writes them in
+from run_codeql_queries import RESULTS_FORMAT, RESULTS_STORE_DIR
 
 
-# Merge the AssetsInParameter and KeywordArgument results 
-def sanitizeLocationName(locationName, sanitized_repo_name):
-    if locationName != "Not Found":
-        return locationName.split(sanitized_repo_name + '/')[1]
-    else:
-        return locationName
-    
-def sanitizeEmptyRows(hostValue, dbValue, userValue, passwordValue):
-    hostValue = str(hostValue).strip()
-    dbValue = str(dbValue).strip()
-    userValue = str(userValue).strip()
-    passwordValue = str(passwordValue).strip()
+CODEQL_OUTPUT_DIR = 'CodeQL/Run Queries/CodeQL_Output'
+REPO_DIR = "AssetBench/Repos"
+# Number of queries whose parquet results of all the repos are kept in
+# memory. The parameter results are read from three queries at once.
+QUERY_STORE_CACHE_SIZE = 3
+# Number of result files read at the same time
+NO_OF_READERS = os.cpu_count()
+# Number of repos whose config file assets are resolved at the same time
+NO_OF_WORKERS = os.cpu_count()
+# Number of repos whose file index is kept in memory
+FILE_INDEX_CACHE_SIZE = 8
+# Directory to save the file index of each repo in, reused until the HEAD of
+# the repo changes. None to build the indexes in memory only.
+FILE_INDEX_DIR = None
+# Number of parsed config files kept in memory
+CONFIG_CACHE_SIZE = 256
+
+PARAMETER_COLUMNS = ['callLocation', 'hostValue', 'hostLocation', 'portValue',
+                     'portLocation', 'dbValue', 'dbLocation', 'userValue', 'userLocation', 
+                     'passwordValue', 'passwordLocation', 'dbType', 'sanitized_repo_name', 'repo_name']
+DSN_COLUMNS = ['callLocation', 'dsn', 'dsnLocation', 'dsnStartColumn', 'dbType', 'sanitized_repo_name', 'repo_name']
+CONFIG_FILE_COLUMNS = ['callLocation', 'fileName', 'hostKey', 'portKey',
+                       'dbKey', 'userKey', 'passwordKey', 'dbType', 'sanitized_repo_name', 'repo_name']
+# Columns read from the results of each query
+QUERY_COLUMNS = {
+    "AssetsinParameter": PARAMETER_COLUMNS[:-2],
+    "AssetsinParameterLocal": PARAMETER_COLUMNS[:-2],
+    "KeywordArguments": PARAMETER_COLUMNS[:-2],
+    "DSN-URI": DSN_COLUMNS[:-2],
+    "ConfigFile": CONFIG_FILE_COLUMNS[:-2],
+}
+
+# Values that count as empty, after str() and strip()
+EMPTY_VALUES = ["Not Found", "''"]
+
+
+# Same as str(value) on each value, missing values become "nan"
+def toStringColumn(column):
+    return column.astype(str).fillna("nan")
+
+# Remove computer location from the locations, e.g. 
+# file:///home/AssetBench/Repos/<repo>/src/db.py:1:2:3:4 -> src/db.py:1:2:3:4
+def sanitizeLocationColumn(locations, sanitized_repo_name):
+    sanitized = locations.astype(str).str.split(sanitized_repo_name + '/', n=2, regex=False).str[1]
+    return locations.where(locations == "Not Found", sanitized)
     
-    return ((hostValue == "Not Found" or hostValue == "''") and (dbValue == "Not Found" or dbValue == "''")
-       and (userValue == "Not Found" or userValue == "''") and 
-      (passwordValue == "Not Found" or passwordValue == "''")) 
-
-
-final_df = pd.DataFrame(columns =['callLocation', 'hostValue', 'hostLocation', 'portValue',
-                                  'portLocation', 'dbValue', 'dbLocation', 'userValue', 'userLocation', 
-                                  'passwordValue', 'passwordLocation', 'dbType'])
-
-for foldername in os.listdir(CODEQL_OUTPUT_DIR):
-    assets_in_parameter_path = os.path.join(CODEQL_OUTPUT_DIR, foldername, foldername + "-AssetsInParameter.csv")
-    keywords_arguments_path = os.path.join(CODEQL_OUTPUT_DIR, foldername, foldername + "-KeywordArguments.csv")
-    if os.path.exists(assets_in_parameter_path):
-        assets_in_parameter_df = pd.read_csv(assets_in_parameter_path)
-        # add the repository name
-        assets_in_parameter_df["sanitized_repo_name"] = foldername 
-        assets_in_parameter_df["repo_name"] = repo_name_dict[foldername]
-        final_df = pd.concat([final_df, assets_in_parameter_df], ignore_index = True)
-    if os.path.exists(keywords_arguments_path):    
-        keywords_arguments_df = pd.read_csv(keywords_arguments_path)
-        # add the repository name
-        keywords_arguments_df["sanitized_repo_name"] = foldername
-        keywords_arguments_df["repo_name"] = repo_name_dict[foldername]
-        final_df = pd.concat([final_df, keywords_arguments_df], ignore_index = True)
+# Rows where all the columns are "Not Found" or ''
+def findEmptyRows(df, columns):
+    is_empty = pd.Series(True, index=df.index)
+    for column in columns:
+        is_empty &= toStringColumn(df[column]).str.strip().isin(EMPTY_VALUES)
+    return is_empty
+
+def findEmptyDSNRows(dsn):
+    dsnValue = toStringColumn(dsn).str.strip(' "\'\t\r\n')
     
-# Remove computer location from the locations
-final_df["callLocation"] = final_df[["callLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.callLocation, x.sanitized_repo_name), axis = 1)
-final_df["hostLocation"] = final_df[["hostLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.hostLocation, x.sanitized_repo_name), axis = 1)
-final_df["portLocation"] = final_df[["portLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.portLocation, x.sanitized_repo_name), axis = 1)
-final_df["dbLocation"] = final_df[["dbLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.dbLocation, x.sanitized_repo_name), axis = 1)
-final_df["userLocation"] = final_df[["userLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.userLocation, x.sanitized_repo_name), axis = 1)
-final_df["passwordLocation"] = final_df[["passwordLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.passwordLocation, x.sanitized_repo_name), axis = 1)
-
-
-# Remove empty entries which are all "Not Found"
-final_df["isEmpty"] = final_df[["hostValue", "dbValue", "userValue", "passwordValue"]].apply(lambda x: 
-                              sanitizeEmptyRows(x.hostValue, x.dbValue, x.userValue, x.passwordValue), axis = 1)
-final_df = final_df[final_df["isEmpty"] == False]
-final_df.drop('isEmpty', axis=1, inplace=True)
-
-# Remove duplicate entries
-final_df = final_df.drop_duplicates(subset=['callLocation', 'hostValue', 'hostLocation', 
-                                 'portValue', 'portLocation', 'dbValue', 'dbLocation', 
-                                 'userValue', 'userLocation', 'passwordValue',
-                                 'passwordLocation', 'repo_name'], 
-                             keep="first").reset_index(drop = True)
-
-
-final_df.to_csv("Results/assets_with_parameter_and_keyword_arguments.csv", index = False)
+    return ((dsnValue == "Not Found") | (dsnValue.str.len() <= 3) | dsnValue.isin(['',':',"@","/", "?",  "&"])
+           | dsnValue.str.startswith(("?", "=", "&", ";", ":", "{", "/", "%s", ".")))
+
+
+query_store_lock = threading.Lock()
+
+
+# Read the parquet results of a query for all the repos at once, split by the
+# repo of their partition
+@lru_cache(maxsize=QUERY_STORE_CACHE_SIZE)
+def readQueryStore(query_name):
+    store_path = os.path.join(RESULTS_STORE_DIR, f"query={query_name}")
+    if not os.path.isdir(store_path):
+        return {}
+
+    # The repo names are kept as strings, even when they look like numbers
+    partitioning = pyarrow.dataset.partitioning(pa.schema([("repo", pa.string())]), flavor="hive")
+    dataset = pyarrow.dataset.dataset(store_path, format="parquet", partitioning=partitioning)
+    store_df = dataset.to_table(columns=QUERY_COLUMNS[query_name] + ["repo"]).to_pandas()
+    return {repo: repo_df.drop(columns="repo").reset_index(drop=True)
+            for repo, repo_df in store_df.groupby("repo", sort=False)}
+
+# Read the results of a query for a repo, None if there are none
+def readQueryResults(foldername, query_name):
+    if RESULTS_FORMAT == "parquet":
+        # The readers of the repos wait for the first one to read the query
+        with query_store_lock:
+            repo_results = readQueryStore(query_name)
+        df = repo_results.get(foldername)
+        return df.copy() if df is not None else None
+
+    result_path = os.path.join(CODEQL_OUTPUT_DIR, foldername, foldername + "-" + query_name + ".csv")
+    return pd.read_csv(result_path) if os.path.exists(result_path) else None
+
+def addRepoName(df, foldername, repo_name_dict, location_columns):
+    df["sanitized_repo_name"] = foldername 
+    df["repo_name"] = repo_name_dict[foldername]
+    for column in location_columns:
+        df[column] = sanitizeLocationColumn(df[column], foldername)
+    return df
+
+
+def readParameterResults(foldername, repo_name_dict):
+    frames = []
+    assets_in_parameter_df = readQueryResults(foldername, "AssetsinParameter")
+    if assets_in_parameter_df is None:
+        # Only the fast local flow query is run when it resolves all the driver calls
+        assets_in_parameter_df = readQueryResults(foldername, "AssetsinParameterLocal")
+    keywords_arguments_df = readQueryResults(foldername, "KeywordArguments")
+
+    location_columns = ["callLocation", "hostLocation", "portLocation", "dbLocation", "userLocation", "passwordLocation"]
+    for df in [assets_in_parameter_df, keywords_arguments_df]:
+        if df is not None:
+            frames.append(addRepoName(df, foldername, repo_name_dict, location_columns))
+    return frames
+
+def readDSNResults(foldername, repo_name_dict):
+    dsn_uri_df = readQueryResults(foldername, "DSN-URI")
+    if dsn_uri_df is None:
+        return []
+
+    # Filter out the anaconda entries
+    dsn_uri_df = dsn_uri_df[~(dsn_uri_df["callLocation"].str.contains("opt/anaconda3") |
+                              dsn_uri_df["dsnLocation"].str.contains("opt/anaconda3"))].copy()
+    return [addRepoName(dsn_uri_df, foldername, repo_name_dict, ["callLocation", "dsnLocation"])]
+
+def readConfigFileResults(foldername, repo_name_dict):
+    config_file_df = readQueryResults(foldername, "ConfigFile")
+    if config_file_df is None:
+        return []
+    return [addRepoName(config_file_df, foldername, repo_name_dict, ["callLocation"])]
+
+
+# Read the results of all the repos in parallel and concat them once, in
+# the order of the repo folders
+def readAllResults(read_repo_results, columns, repo_name_dict):
+    foldernames = os.listdir(CODEQL_OUTPUT_DIR)
+    with ThreadPoolExecutor(max_workers=NO_OF_READERS) as executor:
+        repo_frames = list(executor.map(partial(read_repo_results, repo_name_dict=repo_name_dict), foldernames))
+
+    frames = [df for frames in repo_frames for df in frames]
+    return pd.concat([pd.DataFrame(columns=columns)] + frames, ignore_index = True)
 
 
-# Retrieve DSN-URI results
-def sanitizeDSNRows(dsnValue):
-    dsnValue = str(dsnValue).strip(' "\'\t\r\n')
-    
-    return ((dsnValue == "Not Found" or len(dsnValue) <= 3 or dsnValue in ['',':',"@","/", "?",  "&"]) 
-           or dsnValue.startswith(("?", "=", "&", ";", ":", "{", "/", "%s", ".")))
-
-final_df = pd.DataFrame(columns =['callLocation', 'dsn', 'dsnLocation', 'dsnStartColumn', 'dbType'])
-
-for foldername in os.listdir(CODEQL_OUTPUT_DIR):
-    dsn_uri_path = os.path.join(CODEQL_OUTPUT_DIR, foldername, foldername + "-DSN-URI.csv")
-    if os.path.exists(dsn_uri_path):
-        dsn_uri_df = pd.read_csv(dsn_uri_path)
-        # add the repository name
-        dsn_uri_df["sanitized_repo_name"] = foldername 
-        dsn_uri_df["repo_name"] = repo_name_dict[foldername]
-        # Filter out the anaconda entries
-        dsn_uri_df = dsn_uri_df[~(dsn_uri_df["callLocation"].str.contains("opt/anaconda3") |
-                                  dsn_uri_df["dsnLocation"].str.contains("opt/anaconda3"))]
-        final_df = pd.concat([final_df, dsn_uri_df], ignore_index = True)
-        
-# Remove computer location from the locations
-final_df["callLocation"] = final_df[["callLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.callLocation, x.sanitized_repo_name), axis = 1)
-final_df["dsnLocation"] = final_df[["dsnLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.dsnLocation, x.sanitized_repo_name), axis = 1)
+# Merge the AssetsInParameter and KeywordArgument results 
+def mergeParameterResults(repo_name_dict):
+    final_df = readAllResults(readParameterResults, PARAMETER_COLUMNS, repo_name_dict)
 
-# Remove empty entries which are all "Not Found"
-final_df["isEmpty"] = final_df[["dsn"]].apply(lambda x: 
-                              sanitizeDSNRows(x.dsn), axis = 1)
-final_df = final_df[final_df["isEmpty"] == False]
-final_df.drop('isEmpty', axis=1, inplace=True)
+    # Remove empty entries which are all "Not Found"
+    final_df = final_df[~findEmptyRows(final_df, ["hostValue", "dbValue", "userValue", "passwordValue"])]
 
-# Remove duplicate entries
-final_df = final_df.drop_duplicates(subset=['callLocation', 'dsn', 'dsnLocation', 'dsnStartColumn', 'repo_name'], 
-                             keep="first").reset_index(drop = True)
+    # Remove duplicate entries
+    final_df = final_df.drop_duplicates(subset=['callLocation', 'hostValue', 'hostLocation', 
+                                     'portValue', 'portLocation', 'dbValue', 'dbLocation', 
+                                     'userValue', 'userLocation', 'passwordValue',
+                                     'passwordLocation', 'repo_name'], 
+                                 keep="first").reset_index(drop = True)
 
+    final_df.to_csv("Results/assets_with_parameter_and_keyword_arguments.csv", index = False)
 
-final_df.to_csv("Results/assets_in_dsn.csv", index = False) 
 
-# Merge Config File Assets (Non .py files)
-def sanitizeEmptyRowsConfigFile(fileName, hostKey, portKey, dbKey, userKey, passwordKey):
-    fileName = str(fileName).strip()
-    hostKey = str(hostKey).strip()
-    portKey = str(portKey).strip()
-    dbKey = str(dbKey).strip()
-    userKey = str(userKey).strip()
-    passwordKey = str(passwordKey).strip()
-    
-    return ((fileName == "Not Found" or fileName == "''") and (hostKey == "Not Found" or hostKey == "''")
-       and (portKey == "Not Found" or portKey == "''") and 
-      (dbKey == "Not Found" or dbKey == "''") and (userKey == "Not Found" or userKey == "''") and 
-      (passwordKey == "Not Found" or passwordKey == "''"))  
-
-final_df = pd.DataFrame(columns =['callLocation', 'fileName', 'hostKey', 'portKey',
-                                  'dbKey', 'userKey', 'passwordKey', 'dbType'])
-
-for foldername in os.listdir(CODEQL_OUTPUT_DIR):
-    config_file_path = os.path.join(CODEQL_OUTPUT_DIR, foldername, foldername + "-ConfigFile.csv")
-    if os.path.exists(config_file_path):
-        config_file_df = pd.read_csv(config_file_path)
-        # add the repository name
-        config_file_df["sanitized_repo_name"] = foldername 
-        config_file_df["repo_name"] = repo_name_dict[foldername]
-        final_df = pd.concat([final_df, config_file_df], ignore_index = True)     
-    
-# Remove computer location from the locations
-final_df["callLocation"] = final_df[["callLocation", "sanitized_repo_name"]].apply(lambda x: 
-                            sanitizeLocationName(x.callLocation, x.sanitized_repo_name), axis = 1)
+# Retrieve DSN-URI results
+def mergeDSNResults(repo_name_dict):
+    final_df = readAllResults(readDSNResults, DSN_COLUMNS, repo_name_dict)
 
+    # Remove empty entries which are all "Not Found"
+    final_df = final_df[~findEmptyDSNRows(final_df["dsn"])]
 
-# Remove empty entries which are all "Not Found"
-final_df["isEmpty"] = final_df[["fileName", "hostKey", "portKey", "dbKey", 
-                                "userKey", "passwordKey"]].apply(lambda x: 
-                              sanitizeEmptyRowsConfigFile(x.fileName, x.hostKey, x.portKey, 
-                                                x.dbKey, x.userKey, x.passwordKey), axis = 1)
-final_df = final_df[final_df["isEmpty"] == False]
-final_df.drop('isEmpty', axis=1, inplace=True)
+    # Remove duplicate entries
+    final_df = final_df.drop_duplicates(subset=['callLocation', 'dsn', 'dsnLocation', 'dsnStartColumn', 'repo_name'], 
+                                 keep="first").reset_index(drop = True)
 
-# Remove duplicate entries
-final_df = final_df.drop_duplicates(subset=['callLocation', 'fileName', 'hostKey', 
-                                 'portKey', 'dbKey', 'userKey', 'passwordKey', 'repo_name'], 
-                             keep="first").reset_index(drop = True)
+    final_df.to_csv("Results/assets_in_dsn.csv", index = False) 
 
 
-final_df.to_csv("Results/assets_in_config_file.csv", index = False)
+# Merge Config File Assets (Non .py files)
+def mergeConfigFileResults(repo_name_dict):
+    final_df = readAllResults(readConfigFileResults, CONFIG_FILE_COLUMNS, repo_name_dict)
+
+    # Remove empty entries which are all "Not Found"
+    final_df = final_df[~findEmptyRows(final_df, ["fileName", "hostKey", "portKey", "dbKey", "userKey", "passwordKey"])]
+
+    # Remove duplicate entries
+    final_df = final_df.drop_duplicates(subset=['callLocation', 'fileName', 'hostKey', 
+                                     'portKey', 'dbKey', 'userKey', 'passwordKey', 'repo_name'], 
+                                 keep="first").reset_index(drop = True)
+
+    final_df.to_csv("Results/assets_in_config_file.csv", index = False)
 
 
 # Check jarowinkler distance
@@ -183,24 +219,100 @@ def jaro_similar(a, b):
     match_ratio = jellyfish.jaro_similarity(a, b)
     return match_ratio
 
+def getRepoHead(repo_path):
+    result = subprocess.run(["git", "-C", repo_path, "rev-parse", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+# Index of the files of a repo: the directories (relative to the repo) of
+# each file name, and the file names reversed and sorted, so the names that
+# end with a config file name are found with a binary search
+@lru_cache(maxsize=FILE_INDEX_CACHE_SIZE)
+def getFileIndex(sanitized_repo_name):
+    repo_path = os.path.join(REPO_DIR, sanitized_repo_name)
+    index_path = os.path.join(FILE_INDEX_DIR, sanitized_repo_name + ".json") if FILE_INDEX_DIR else None
+    head = getRepoHead(repo_path) if index_path else None
+
+    dirs_by_name = None
+    if index_path and head and os.path.exists(index_path):
+        with open(index_path) as f:
+            saved_index = json.load(f)
+        if saved_index["head"] == head:
+            dirs_by_name = saved_index["files"]
+
+    if dirs_by_name is None:
+        dirs_by_name = {}
+        for root, dirs, files in os.walk(repo_path):
+            if ".git" in dirs:
+                dirs.remove(".git")
+            rel_dir = os.path.relpath(root, repo_path)
+            for file in files:
+                dirs_by_name.setdefault(file, []).append("" if rel_dir == "." else rel_dir)
+
+        if index_path and head:
+            os.makedirs(FILE_INDEX_DIR, exist_ok=True)
+            with open(index_path, "w") as f:
+                json.dump({"head": head, "files": dirs_by_name}, f)
+
+    reversed_names = sorted(name[::-1] for name in dirs_by_name)
+    return (reversed_names, dirs_by_name)
+
+# Get the files (relative to the repo) whose name ends with configFile
+def findIndexedFiles(sanitized_repo_name, configFile):
+    reversed_names, dirs_by_name = getFileIndex(sanitized_repo_name)
+    reversed_suffix = configFile[::-1]
+
+    idx = bisect.bisect_left(reversed_names, reversed_suffix)
+    while idx < len(reversed_names) and reversed_names[idx].startswith(reversed_suffix):
+        name = reversed_names[idx][::-1]
+        for rel_dir in dirs_by_name[name]:
+            yield os.path.join(rel_dir, name)
+        idx += 1
+
+# Number of directories to go up and down from one directory to the other
+def getPathDistance(dir_a, dir_b):
+    parts_a = [part for part in dir_a.split("/") if part]
+    parts_b = [part for part in dir_b.split("/") if part]
+    common = 0
+    while common < min(len(parts_a), len(parts_b)) and parts_a[common] == parts_b[common]:
+        common += 1
+    return len(parts_a) + len(parts_b) - 2 * common
+
+# Get the files ending with the config file name, the most relevant first:
+# the closest ones to the file of the call, then the most similar paths
 def findRelevantFiles(callLocation, configFile, sanitized_repo_name):
+    repo_path = os.path.join(REPO_DIR, sanitized_repo_name)
+    callLocationPath = os.path.join(repo_path, callLocation)
+    # The location is <file>:<start line>:<start column>:<end line>:<end column>
+    call_dir = os.path.dirname(callLocation.split(":")[0])
+
+    candidates = []
+    for rel_path in findIndexedFiles(sanitized_repo_name, configFile):
+        distance = getPathDistance(call_dir, os.path.dirname(rel_path))
+        candidates.append((distance, os.path.join(repo_path, rel_path)))
+    candidates.sort()
+
+    # The jaro similarity is only computed to break the ties
     rel_files = []
-    callLocationPath = os.path.join(REPO_DIR, sanitized_repo_name, callLocation)
-
-    for root, dirs, files in os.walk(os.path.join(REPO_DIR, sanitized_repo_name)):
-        for file in files:
-            if file.endswith(configFile):
-                match_file_path = os.path.join(root, file) 
-                file_similarity_score = jaro_similar(match_file_path, callLocationPath)
-                heapq.heappush(rel_files, (-file_similarity_score, match_file_path))
+    for _, group in itertools.groupby(candidates, key=lambda candidate: candidate[0]):
+        paths = [path for _, path in group]
+        if len(paths) > 1:
+            paths.sort(key=lambda path: -jaro_similar(path, callLocationPath))
+        rel_files.extend(paths)
                 
     return rel_files  
 
-def getKeyValueLocation(file_path, key, value):
-    with open(file_path, 'r') as f:
-        for i, line in enumerate(f):
-            if str(key) in line and str(value) in line:
-                return i + 1
+# Get the first line that has the key and the value, from the lines of
+# the key in the index of the config file
+def getKeyValueLocation(config, key, value):
+    _, lines, key_lines = config
+    # The lines of a key are only searched the first time it is asked for
+    if key not in key_lines:
+        key_name = str(key)
+        key_lines[key] = [i for i, line in enumerate(lines) if key_name in line]
+
+    for i in key_lines[key]:
+        if str(value) in lines[i]:
+            return i + 1
     
     return -1
    
@@ -215,6 +327,36 @@ def parseJSONFile(f):
     return json.load(f)
 
 
+# Read and parse a config file once, however many calls point to it. Gives
+# the parsed document, its lines and the index of the lines that have each
+# key, which is filled as the keys are looked up. A file that can not be
+# read or parsed has no keys.
+@lru_cache(maxsize=CONFIG_CACHE_SIZE)
+def loadConfigFile(file_path, file_type):
+    try:
+        with open(file_path, 'r') as f:
+            text = f.read()
+
+        data_mp = None
+        if file_type == "YAML":
+            data_mp = parseYAMLFile(text)
+        elif file_type == "XML":
+            data_mp = parseXMLFile(text)
+        elif file_type == "JSON":
+            data_mp = parseJSONFile(io.StringIO(text))
+    except (OSError, ValueError, yaml.YAMLError, ExpatError):
+        text = ""
+        data_mp = None
+
+    if not isinstance(data_mp, dict):
+        data_mp = {}
+
+    # The same lines as reading the file line by line
+    lines = list(io.StringIO(text))
+
+    return (data_mp, lines, {})
+
+
 def getFileType(file_name):
     if ".yml" in file_name or ".yaml" in file_name:
         return "YAML"
@@ -222,7 +364,7 @@ def getFileType(file_name):
     if ".xml" in file_name:
         return "XML"
     
-    if ".js" in file_nme or ".json" in file_name:
+    if ".js" in file_name or ".json" in file_name:
         return "JSON"
     
     return None
@@ -238,39 +380,32 @@ def parseFile(row, file_type):
     rel_files = findRelevantFiles(callLocation, configFile, sanitizedRepoName)
     curr_res = {"callLocation": callLocation}
     
-    while rel_files:
-        # choose the most relevant file based on jaro-winkler similarity
-        _,curr_file = rel_files.pop()
-        with open(curr_file, 'r') as f:
-            data_mp = None
-            if file_type == "YAML":
-                data_mp = parseYAMLFile(f)
-            elif file_type == "XML":
-                data_mp = parseXMLFile(f)
-            elif file_type == "JSON":
-                data_mp = parseJSONFile(f)
-    
-                
-            if row["hostKey"] in data_mp:
-                curr_res["hostValue"] = data_mp[row["hostKey"]]
-                line_no = getKeyValueLocation(f.name, row["hostKey"], curr_res["hostValue"])
-                curr_res["hostLocation"] = f.name.split(sanitizedRepoName + "/")[1] + ":" + str(line_no)
-            if row["portKey"] in data_mp:
-                curr_res["portValue"] = data_mp[row["portKey"]]
-                line_no = getKeyValueLocation(f.name, row["portKey"], curr_res["portValue"])
-                curr_res["portLocation"] = f.name.split(sanitizedRepoName + "/")[1] + ":" + str(line_no)
-            if row["dbKey"] in data_mp:
-                curr_res["dbValue"] = data_mp[row["dbKey"]]
-                line_no = getKeyValueLocation(f.name, row["dbKey"], curr_res["dbValue"])
-                curr_res["dbLocation"] = f.name.split(sanitizedRepoName + "/")[1] + ":" + str(line_no)
-            if row["userKey"] in data_mp:
-                curr_res["userValue"] = data_mp[row["userKey"]]
-                line_no = getKeyValueLocation(f.name, row["userKey"], curr_res["userValue"])
-                curr_res["userLocation"] = f.name.split(sanitizedRepoName + "/")[1] + ":" + str(line_no)
-            if row["passwordKey"] in data_mp:
-                curr_res["passwordValue"] = data_mp[row["passwordKey"]]   
-                line_no = getKeyValueLocation(f.name, row["passwordKey"], curr_res["passwordValue"])
-                curr_res["passwordLocation"] = f.name.split(sanitizedRepoName + "/")[1] + ":" + str(line_no)
+    for curr_file in rel_files:
+        # choose the most relevant file
+        config = loadConfigFile(curr_file, file_type)
+        data_mp = config[0]
+        relative_path = curr_file.split(sanitizedRepoName + "/")[1]
+
+        if row["hostKey"] in data_mp:
+            curr_res["hostValue"] = data_mp[row["hostKey"]]
+            line_no = getKeyValueLocation(config, row["hostKey"], curr_res["hostValue"])
+            curr_res["hostLocation"] = relative_path + ":" + str(line_no)
+        if row["portKey"] in data_mp:
+            curr_res["portValue"] = data_mp[row["portKey"]]
+            line_no = getKeyValueLocation(config, row["portKey"], curr_res["portValue"])
+            curr_res["portLocation"] = relative_path + ":" + str(line_no)
+        if row["dbKey"] in data_mp:
+            curr_res["dbValue"] = data_mp[row["dbKey"]]
+            line_no = getKeyValueLocation(config, row["dbKey"], curr_res["dbValue"])
+            curr_res["dbLocation"] = relative_path + ":" + str(line_no)
+        if row["userKey"] in data_mp:
+            curr_res["userValue"] = data_mp[row["userKey"]]
+            line_no = getKeyValueLocation(config, row["userKey"], curr_res["userValue"])
+            curr_res["userLocation"] = relative_path + ":" + str(line_no)
+        if row["passwordKey"] in data_mp:
+            curr_res["passwordValue"] = data_mp[row["passwordKey"]]   
+            line_no = getKeyValueLocation(config, row["passwordKey"], curr_res["passwordValue"])
+            curr_res["passwordLocation"] = relative_path + ":" + str(line_no)
         
         if len(curr_res) > 0:
             curr_res["dbType"] = row["dbType"]
@@ -280,20 +415,51 @@ def parseFile(row, file_type):
     
     return None
 
-REPO_DIR = "AssetBench/Repos"
-config_df = pd.read_csv("Results/assets_in_config_file.csv")
+# Resolve the config file assets of the rows of one repo
+def resolveRepoConfigFileAssets(repo_config_df):
+    final_res = []
 
-final_res = []
+    for index, row in repo_config_df.iterrows():
+        file_type = getFileType(row["fileName"]) 
+        if not file_type:
+            continue
+            
+        curr_res = parseFile(row, file_type)
+        if curr_res:
+            final_res.append(curr_res)          
+
+    return final_res
+
+
+# Resolve the repos in a pool of processes, each repo in one process so its
+# file index and parsed config files are reused. The results are written as
+# the repos finish, in the order of the repos in assets_in_config_file.csv.
+def resolveConfigFileAssets():
+    config_df = pd.read_csv("Results/assets_in_config_file.csv")
+    repo_config_dfs = [repo_config_df for _, repo_config_df in config_df.groupby("sanitized_repo_name", sort=False)]
+
+    with open("Results/assets_in_config_file_final.csv", "w", newline="") as f:
+        pd.DataFrame(columns=PARAMETER_COLUMNS).to_csv(f, index = False)
+
+        with ProcessPoolExecutor(max_workers=NO_OF_WORKERS) as executor:
+            for final_res in executor.map(resolveRepoConfigFileAssets, repo_config_dfs):
+                if final_res:
+                    # object dtype keeps the values as parsed, e.g. a port
+                    # is not turned into a float when another row has none
+                    final_res_df = pd.DataFrame(final_res, columns=PARAMETER_COLUMNS, dtype=object)
+                    final_res_df.to_csv(f, header = False, index = False)
+                    f.flush()
+
+
+def main():
+    repo_list_df = pd.read_csv("repo-list.csv")
+    repo_name_dict = repo_list_df.set_index('sanitized_repo_name')["repo_name"].to_dict()
+
+    mergeParameterResults(repo_name_dict)
+    mergeDSNResults(repo_name_dict)
+    mergeConfigFileResults(repo_name_dict)
+    resolveConfigFileAssets()
 
-for index, row in config_df.iterrows():
-    file_type = getFileType(row["fileName"]) 
-    if not file_type:
-        continue
-        
-    curr_res = parseFile(row, file_type)
-    if curr_res:
-        final_res.append(curr_res)          
 
-if final_res:
-    final_res_df = pd.DataFrame(final_res)
-    final_res_df.to_csv("Results/assets_in_config_file_final.csv", index = False) 
\ No newline at end of file
+if __name__ == "__main__":
+    main()
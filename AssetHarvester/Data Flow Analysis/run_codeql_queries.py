@@ -4,52 +4,645 @@ import numpy as np
 import pandas as pd
 import os, sys
 import shutil
+import glob
+import hashlib
+import subprocess
+import threading
+import ast
+import re
+import time
+import signal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 REPO_DIR = "AssetBench/Repos/"
 CODEQL_DATABASE_DIR = "CodeQL/Run Queries/CodeQL_Python_Database/"
 OUTPUT_DIR = "CodeQL/Run Queries/CodeQL_Output/"
 QUERY_PATH = "CodeQL/detect-asset-codeql/codeql-custom-queries-python/queries/common/"
+# Manifest of each repo with the keys of its database and query results.
+# A database is rebuilt only when the source tree or the codeql version
+# changes, and a query is re-run only when the query or the database changes.
+MANIFEST_DIR = "CodeQL/Run Queries/Manifests/"
+# Format of the decoded results: "csv" (<repo>/<repo>-<query>.csv in
+# OUTPUT_DIR) or "parquet" (one store in RESULTS_STORE_DIR, partitioned as
+# query=<query>/repo=<repo>/part-0.parquet)
+RESULTS_FORMAT = "csv"
+RESULTS_STORE_DIR = "CodeQL/Run Queries/CodeQL_Results/"
+
+# Every codeql command is recorded as a json line in RUN_MANIFEST_PATH with
+# its exit code, wall and cpu time and peak RSS. The stderr of the commands
+# goes to LOG_DIR/<repo>.log.
+RUN_MANIFEST_PATH = "CodeQL/Run Queries/run-manifest.jsonl"
+LOG_DIR = "CodeQL/Run Queries/Logs/"
+# Timeouts in seconds (None for no timeout). A repo whose command times out
+# is added to QUARANTINE_PATH and skipped by the next runs until it is
+# removed from there.
+DATABASE_TIMEOUT = 2 * 60 * 60
+QUERY_TIMEOUT = 60 * 60
+QUARANTINE_PATH = "CodeQL/Run Queries/quarantine.csv"
+
+# Skip the repos that never import one of the driver modules the queries
+# look for. The skipped repos are written to SKIPPED_REPOS_PATH with the
+# reason.
+PREFILTER_IMPORTS = True
+SKIPPED_REPOS_PATH = "CodeQL/Run Queries/skipped-repos.csv"
+# Top level modules of the driver calls in the QL classes
+DRIVER_MODULES = {
+    "MySQLdb",
+    "_mssql",
+    "aiomysql",
+    "aiopg",
+    "asyncpg",
+    "jaydebeapi",
+    "mysql",
+    "peewee",
+    "psycopg",
+    "psycopg2",
+    "pymongo",
+    "pymssql",
+    "pymysql",
+    "pyodbc",
+    "sqlalchemy",
+}
+# Files that never mention a driver module are not parsed
+DRIVER_NAME_PATTERN = re.compile(rb"\b(" + b"|".join(re.escape(module.encode("utf-8")) for module in sorted(DRIVER_MODULES)) + rb")\b")
+# Used for the files that do not parse, e.g. python 2 files
+DRIVER_IMPORT_PATTERN = re.compile(rb"^\s*(?:import|from)\s+(" + b"|".join(re.escape(module.encode("utf-8")) for module in sorted(DRIVER_MODULES)) + rb")\b", re.MULTILINE)
+
+# Global budget of threads and RAM (in MB) shared by the repos that are
+# processed at the same time
 NO_OF_THREADS = os.cpu_count()
+RAM_BUDGET = int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.8 / (1024 * 1024))
+# Number of repos processed at the same time. Each of them gets an equal
+# share of the threads and the RAM.
+NO_OF_CONCURRENT_REPOS = max(1, NO_OF_THREADS // 4)
 
+# "suite" evaluates all the queries of a database in one codeql process that
+# shares the evaluator cache, "single" runs codeql once per query
+QUERY_MODE = "suite"
 
-repos = pd.read_csv("repo-list.csv")
-repo_name_dict = repos.set_index("sanitized_repo_name")["repo_name"].to_dict()
-repo_names = repos["sanitized_repo_name"].tolist()
+# Queries that have a fast variant with local flow only
+FAST_QUERIES = {"AssetsinParameter.ql": "AssetsinParameterLocal.ql"}
+# "full" runs the global data flow queries, "fast" their local flow variants
+# instead, and "tiered" runs the fast variants first and the global query
+# only on the repos where they leave some driver calls unresolved
+QUERY_TIER = "tiered"
+# The fast results with "Not Found" in one of these columns are unresolved.
+# A missing port usually means the default port, so it does not count.
+UNRESOLVED_COLUMNS = ["hostValue", "dbValue", "userValue", "passwordValue"]
 
+THREADS_PER_REPO = max(1, NO_OF_THREADS // NO_OF_CONCURRENT_REPOS)
+RAM_PER_REPO = max(1024, RAM_BUDGET // NO_OF_CONCURRENT_REPOS)
 
+print_lock = threading.Lock()
+run_manifest_lock = threading.Lock()
 
-def runSingleQuery(db_path, query_path, bqrs_out_path, csv_out_path):
-    run_cmd = f'codeql query run --warnings=hide --threads={NO_OF_THREADS} --database="{db_path}" --output="{bqrs_out_path}" "{query_path}" > /dev/null'
-    os.system(run_cmd)
-    
-    decode_cmd = f'codeql bqrs decode --format=csv --output="{csv_out_path}" "{bqrs_out_path}" > /dev/null'
-    os.system(decode_cmd)
+# Set once in main()
+CODEQL_VERSION = None
+
+
+
+# Run a codeql command and record its telemetry. Returns True if it exited
+# with 0 within the timeout. The stdout of the command is passed to
+# read_stdout, if given, which is run in a thread while the command runs.
+def runCommand(repo_name, stage, cmd, timeout, read_stdout=None, **details):
+    os.makedirs(LOG_DIR, exist_ok=True)
+    started = time.time()
+    start_time = time.perf_counter()
+
+    with open(os.path.join(LOG_DIR, repo_name + ".log"), "ab") as log_file:
+        # The command gets its own process group, so the JVM started by the
+        # codeql launcher is killed with it on a timeout
+        stdout = subprocess.PIPE if read_stdout else subprocess.DEVNULL
+        process = subprocess.Popen(cmd, stdout=stdout, stderr=log_file, start_new_session=True)
+        output_errors = []
+        if read_stdout:
+            reader = threading.Thread(target=readCommandOutput, args=(read_stdout, process.stdout, output_errors))
+            reader.start()
+        timed_out = False
+        peak_rss = 0
+        poll_interval = 0.05
+
+        while True:
+            # wait4 gives the cpu time of the command and its children
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+
+            peak_rss = max(peak_rss, getProcessGroupRss(process.pid))
+            if timeout and not timed_out and time.perf_counter() - start_time > timeout:
+                timed_out = True
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, 1.0)
+
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if read_stdout:
+            reader.join()
+            process.stdout.close()
+
+    telemetry = {
+        "repo": repo_name,
+        "stage": stage,
+        **details,
+        "started": round(started, 3),
+        "exit_code": process.returncode,
+        "timed_out": timed_out,
+        "wall_seconds": round(time.perf_counter() - start_time, 3),
+        "cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+    }
+    if output_errors:
+        telemetry["output_error"] = str(output_errors[0])
+    if stage == "database create":
+        telemetry["database_size_mb"] = round(getDirectorySize(CODEQL_DATABASE_DIR + repo_name) / (1024 * 1024), 1)
+    recordTelemetry(telemetry)
+
+    if telemetry["timed_out"]:
+        log(f"Timed out after {timeout}s, quarantining repo: {repo_name} ({stage})")
+        quarantineRepo(repo_name, stage)
+    elif process.returncode != 0:
+        log(f"Failed with exit code {process.returncode}: {repo_name} ({stage}), see {LOG_DIR}{repo_name}.log")
+    elif output_errors:
+        log(f"Could not read the output of {repo_name} ({stage}): {output_errors[0]}")
+
+    return process.returncode == 0 and not telemetry["timed_out"] and not output_errors
+
+
+# Pass the stdout of a command to read_stdout. What it leaves unread is
+# drained, so the command is never blocked on a full pipe.
+def readCommandOutput(read_stdout, stdout, output_errors):
+    try:
+        read_stdout(stdout)
+    except Exception as e:
+        output_errors.append(e)
+    finally:
+        while stdout.read(1024 * 1024):
+            pass
+
+
+# Sum of the peak RSS (VmHWM, in kB) of the processes in a process group.
+# The ru_maxrss of a child also counts the RSS of this script before the
+# exec, so it is sampled from /proc instead.
+def getProcessGroupRss(pgid):
+    group_rss = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # The fields after the command name, which may have spaces
+                stat_fields = f.read().rsplit(")", 1)[1].split()
+            if int(stat_fields[2]) != pgid:
+                continue
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        group_rss += int(line.split()[1])
+                        break
+        except (OSError, IndexError, ValueError):
+            pass
+    return group_rss
+
+
+def recordTelemetry(telemetry):
+    with run_manifest_lock:
+        with open(RUN_MANIFEST_PATH, "a") as f:
+            f.write(json.dumps(telemetry) + "\n")
+
+
+def getDirectorySize(dir_path):
+    dir_size = 0
+    for root, dirs, files in os.walk(dir_path):
+        for filename in files:
+            try:
+                dir_size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return dir_size
+
+
+def quarantineRepo(repo_name, stage):
+    with run_manifest_lock:
+        write_header = not os.path.exists(QUARANTINE_PATH)
+        with open(QUARANTINE_PATH, "a", newline="") as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(["sanitized_repo_name", "stage", "timestamp"])
+            writer.writerow([repo_name, stage, int(time.time())])
+
+
+def getQuarantinedRepos():
+    if not os.path.exists(QUARANTINE_PATH):
+        return set()
+    return set(pd.read_csv(QUARANTINE_PATH)["sanitized_repo_name"].astype(str))
+
+
+def runSingleQuery(repo_name, query_path, bqrs_out_path, result_path):
+    run_cmd = ["codeql", "query", "run", "--warnings=hide", f"--threads={THREADS_PER_REPO}", f"--ram={RAM_PER_REPO}", f"--database={CODEQL_DATABASE_DIR + repo_name}", f"--output={bqrs_out_path}", query_path]
+    if runCommand(repo_name, "query run", run_cmd, QUERY_TIMEOUT, query=os.path.basename(query_path)):
+        decodeResults(repo_name, bqrs_out_path, result_path)
+
+
+# Decode the select results of a bqrs file to csv, or to json that is read
+# from the stdout of the decode and written to a parquet partition
+def decodeResults(repo_name, bqrs_out_path, result_path):
+    query_name = os.path.basename(bqrs_out_path)
+    if RESULTS_FORMAT != "parquet":
+        decode_cmd = ["codeql", "bqrs", "decode", "--format=csv", f"--output={result_path}", bqrs_out_path]
+        runCommand(repo_name, "bqrs decode", decode_cmd, QUERY_TIMEOUT, query=query_name)
+        return
+
+    decoded = []
+    decode_cmd = ["codeql", "bqrs", "decode", "--format=json", "--result-set=#select", bqrs_out_path]
+    if not runCommand(repo_name, "bqrs decode", decode_cmd, QUERY_TIMEOUT,
+                      read_stdout=lambda stdout: decoded.append(json.load(stdout)), query=query_name):
+        return
+
+    results = decoded[0]
+    select = results["#select"]
+    columns = [column.get("name", f"col{idx}") for idx, column in enumerate(select["columns"])]
+    # Entities (e.g. locations) are decoded as objects with a label. All the
+    # values are stored as strings, so every partition has the same schema.
+    rows = [
+        [str(value["label"]) if isinstance(value, dict) else str(value) for value in row]
+        for row in select["tuples"]
+    ]
+    results_df = pd.DataFrame(rows, columns=columns, dtype=object).astype(str)
+
+    os.makedirs(os.path.dirname(result_path), exist_ok=True)
+    results_df.to_parquet(result_path + ".tmp", index=False)
+    os.replace(result_path + ".tmp", result_path)
+
+
+def readResults(result_path):
+    if RESULTS_FORMAT == "parquet":
+        return pd.read_parquet(result_path)
+    return pd.read_csv(result_path, dtype=str, keep_default_na=False)
     
+def getQueryFiles():
+    return sorted(filename for filename in os.listdir(QUERY_PATH) if filename.endswith(".ql"))
+
+
+# Check that all the queries compile before any repo is run, so a broken
+# query fails the run once instead of failing in every repo
+def compileQueries():
+    compile_cmd = ["codeql", "query", "compile", "--check-only", "--warnings=hide", f"--threads={NO_OF_THREADS}"]
+    result = subprocess.run(compile_cmd + [QUERY_PATH + filename for filename in getQueryFiles()], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+    return result.returncode == 0
+
+
+def getCodeQLVersion():
+    result = subprocess.run(["codeql", "version", "--format=terse"], capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def getFileHash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Key of the database: the tree of the checked out commit and the codeql
+# version. None if the repo is not a git repository, then the database is
+# always rebuilt.
+def getDatabaseKey(repo_name):
+    result = subprocess.run(["git", "-C", REPO_DIR + repo_name, "rev-parse", "HEAD^{tree}"], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    tree_hash = result.stdout.strip()
+    return hashlib.sha256(f"{tree_hash}\n{CODEQL_VERSION}".encode("utf-8")).hexdigest()
+
+
+# Key of a query result: the query, the libraries next to it and the database
+def getQueryKey(filename, db_key):
+    query_hash = hashlib.sha256()
+    query_hash.update(db_key.encode("utf-8"))
+    query_hash.update(getFileHash(QUERY_PATH + filename).encode("utf-8"))
+    for library in sorted(os.listdir(QUERY_PATH)):
+        if library.endswith(".qll"):
+            query_hash.update(getFileHash(QUERY_PATH + library).encode("utf-8"))
+    return query_hash.hexdigest()
+
+
+def loadManifest(repo_name):
+    manifest_path = os.path.join(MANIFEST_DIR, repo_name + ".json")
+    if not os.path.exists(manifest_path):
+        return {"database": None, "queries": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+# Write to a temporary file first, so an interrupted run never leaves a
+# half-written manifest
+def saveManifest(repo_name, manifest):
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    manifest_path = os.path.join(MANIFEST_DIR, repo_name + ".json")
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def getOutputPaths(repo_name, filename):
+    query_name = filename[:-len(".ql")]
+    out_dir_path = OUTPUT_DIR + repo_name
+    if RESULTS_FORMAT == "parquet":
+        result_path = os.path.join(RESULTS_STORE_DIR, f"query={query_name}", f"repo={repo_name}", "part-0.parquet")
+    else:
+        result_path = os.path.join(out_dir_path, repo_name + "-" + query_name + ".csv")
+    bqrs_out_path = os.path.join(out_dir_path, repo_name + "-" + query_name + ".bqrs")
+    return (result_path, bqrs_out_path)
+
+
+# The results are in <db>/results/<query pack>/<query path>.bqrs
+def findSuiteResults(db_path, filename):
+    return glob.glob(os.path.join(glob.escape(db_path), "results", "**", filename[:-len(".ql")] + ".bqrs"), recursive=True)
+
+
+# Evaluate all the queries on the database in one codeql process. The
+# results are written inside the database and copied to the same bqrs and
+# result files as runSingleQuery.
+def runQuerySuite(repo_name, query_files):
+    db_path = CODEQL_DATABASE_DIR + repo_name
+    query_paths = [QUERY_PATH + filename for filename in query_files]
+
+    for filename in query_files:
+        for old_results in findSuiteResults(db_path, filename):
+            os.remove(old_results)
+
+    run_cmd = ["codeql", "database", "run-queries", "--warnings=hide", "--rerun", f"--threads={THREADS_PER_REPO}", f"--ram={RAM_PER_REPO}", db_path] + query_paths
+    # Queries that finished before a failure or a timeout still have results
+    timeout = QUERY_TIMEOUT * len(query_files) if QUERY_TIMEOUT else None
+    runCommand(repo_name, "run-queries", run_cmd, timeout, queries=query_files)
+
+    out_dir_path = OUTPUT_DIR + repo_name
+    if not os.path.exists(out_dir_path):
+        os.mkdir(out_dir_path)
+
+    for filename in query_files:
+        result_path, bqrs_out_path = getOutputPaths(repo_name, filename)
+
+        results = findSuiteResults(db_path, filename)
+        if not results:
+            log(f"No results of {filename} for repo: {repo_name}")
+            continue
+        shutil.copyfile(results[0], bqrs_out_path)
+
+        decodeResults(repo_name, bqrs_out_path, result_path)
+
+
+# Run the queries that are missing or out of date, and record their keys
+# in the manifest
+def runStaleQueries(repo_name, manifest, query_keys, query_files):
+    stale_files = []
+    for filename in query_files:
+        result_path, _ = getOutputPaths(repo_name, filename)
+        if query_keys[filename] is None or manifest["queries"].get(filename) != query_keys[filename] or not os.path.exists(result_path):
+            stale_files.append(filename)
+
+    if not stale_files:
+        return
+
+    out_dir_path = OUTPUT_DIR + repo_name
+    if not os.path.exists(out_dir_path):
+        os.mkdir(out_dir_path)
+
+    # A failed query must not leave its old results behind
+    for filename in stale_files:
+        for out_path in getOutputPaths(repo_name, filename):
+            if os.path.exists(out_path):
+                os.remove(out_path)
+        manifest["queries"].pop(filename, None)
+
+    if QUERY_MODE == "suite":
+        runQuerySuite(repo_name, stale_files)
+    else:
+        for filename in stale_files:
+            result_path, bqrs_out_path = getOutputPaths(repo_name, filename)
+            runSingleQuery(repo_name, QUERY_PATH + filename, bqrs_out_path, result_path)
+
+    for filename in stale_files:
+        result_path, _ = getOutputPaths(repo_name, filename)
+        if query_keys[filename] is not None and os.path.exists(result_path):
+            manifest["queries"][filename] = query_keys[filename]
+
+
+# Check if the fast query left a driver call with unresolved arguments
+def hasUnresolvedCalls(result_path):
+    if not os.path.exists(result_path):
+        return True
+    results_df = readResults(result_path)
+    columns = [column for column in UNRESOLVED_COLUMNS if column in results_df.columns]
+    return bool((results_df[columns] == "Not Found").any(axis=None))
+
+
+# Remove the results of a query unless they are up to date, so that old
+# results are never merged with the new ones
+def removeStaleResults(repo_name, manifest, query_keys, filename):
+    if query_keys[filename] is not None and manifest["queries"].get(filename) == query_keys[filename]:
+        return
+    removeResults(repo_name, manifest, filename)
+
+
+def removeResults(repo_name, manifest, filename):
+    for out_path in getOutputPaths(repo_name, filename):
+        if os.path.exists(out_path):
+            os.remove(out_path)
+    manifest["queries"].pop(filename, None)
+
+
 def runQueries(repo_name):
-    for filename in os.listdir(QUERY_PATH):
-        query_name = filename.strip(".ql")
-        out_dir_path = OUTPUT_DIR + repo_name
-        if not os.path.exists(out_dir_path):
-            os.mkdir(out_dir_path)
-        
-        csv_out_path = os.path.join(out_dir_path, repo_name + "-" + query_name + ".csv")
-        bqrs_out_path = os.path.join(out_dir_path, repo_name + "-" + query_name + ".bqrs")
-            
-        runSingleQuery(CODEQL_DATABASE_DIR + repo_name, QUERY_PATH + filename, bqrs_out_path, csv_out_path)  
+    manifest = loadManifest(repo_name)
+    if manifest["database"] is None or manifest["database"]["key"] is None:
+        # The database is not cached, so the results are not either
+        query_keys = {filename: None for filename in getQueryFiles()}
+    else:
+        db_key = manifest["database"]["key"]
+        query_keys = {filename: getQueryKey(filename, db_key) for filename in getQueryFiles()}
+
+    if QUERY_TIER == "full":
+        fast_files = set(FAST_QUERIES.values())
+        runStaleQueries(repo_name, manifest, query_keys, [filename for filename in query_keys if filename not in fast_files])
+        # The results of a fast query from a tiered run would be merged in
+        # place of the global results if the global query fails
+        for fast_file in fast_files:
+            removeResults(repo_name, manifest, fast_file)
+    else:
+        runStaleQueries(repo_name, manifest, query_keys, [filename for filename in query_keys if filename not in FAST_QUERIES])
+
+        for global_file, fast_file in FAST_QUERIES.items():
+            if global_file not in query_keys:
+                continue
+            fast_result_path, _ = getOutputPaths(repo_name, fast_file)
+            if QUERY_TIER == "tiered" and hasUnresolvedCalls(fast_result_path):
+                log(f"Running global {global_file} for unresolved driver calls: {repo_name}")
+                runStaleQueries(repo_name, manifest, query_keys, [global_file])
+            else:
+                removeStaleResults(repo_name, manifest, query_keys, global_file)
+
+    saveManifest(repo_name, manifest)
         
     
-
+# Create the database unless the one on disk was built from the same tree
+# with the same codeql version. Returns False if the database could not be
+# created.
 def createDatabase(repo_name):
-    if not os.path.exists(CODEQL_DATABASE_DIR + repo_name):
-        db_create_cmd = f'codeql database create "{CODEQL_DATABASE_DIR + repo_name}" --source-root "{REPO_DIR + repo_name}" --language=python --threads={NO_OF_THREADS} > /dev/null'
-        os.system(db_create_cmd)
+    db_path = CODEQL_DATABASE_DIR + repo_name
+    manifest = loadManifest(repo_name)
+    db_key = getDatabaseKey(repo_name)
+
+    if db_key is not None and os.path.exists(db_path) and manifest["database"] is not None and manifest["database"]["key"] == db_key:
+        log(f"Database is up to date: {repo_name}")
+        return True
+
+    db_create_cmd = ["codeql", "database", "create", db_path, "--overwrite", f"--source-root={REPO_DIR + repo_name}", "--language=python", f"--threads={THREADS_PER_REPO}", f"--ram={RAM_PER_REPO}"]
+    created = runCommand(repo_name, "database create", db_create_cmd, DATABASE_TIMEOUT)
 
+    # The old query results are stale with the new database
+    manifest["database"] = {"key": db_key, "codeql_version": CODEQL_VERSION} if created else None
+    manifest["queries"] = {}
+    saveManifest(repo_name, manifest)
+    return created
 
 
-for idx, repo_name in enumerate(repo_names):
-    print(f"Working with repo: {repo_name} - ({str(idx + 1)}/{len(repo_names)})")
-    print("Creating python database...")
-    createDatabase(repo_name)
-    print("Running codeql queries...")
+# Get the driver modules imported in a python file
+def findDriverImports(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            source = f.read()
+    except OSError:
+        return set()
+
+    if not DRIVER_NAME_PATTERN.search(source):
+        return set()
+
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return {match.decode("utf-8") for match in DRIVER_IMPORT_PATTERN.findall(source)}
+
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            modules.add(node.module.split(".")[0])
+    return modules & DRIVER_MODULES
+
+
+# Find the first python file of a repo that imports a driver module, and
+# the size of its python sources on the same walk. Returns (repo_name, skip
+# reason, repo size), the reason is None if the repo is kept.
+def checkRepoImports(repo_name):
+    no_of_python_files = 0
+    repo_size = 0
+    has_driver_import = False
+    for root, dirs, files in os.walk(REPO_DIR + repo_name):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        for filename in files:
+            if filename.endswith(".py"):
+                file_path = os.path.join(root, filename)
+                no_of_python_files += 1
+                repo_size += getFileSize(file_path)
+                # The rest of the files are only needed for the size
+                if not has_driver_import and findDriverImports(file_path):
+                    has_driver_import = True
+
+    if has_driver_import:
+        return (repo_name, None, repo_size)
+    if no_of_python_files == 0:
+        return (repo_name, "no python files", repo_size)
+    return (repo_name, f"no database driver imports in {no_of_python_files} python files", repo_size)
+
+
+# Check the repos in parallel and write the skipped ones with the reasons.
+# Returns the kept repos and the sizes of all the repos.
+def prefilterRepos(repo_names):
+    skip_reasons = {}
+    repo_sizes = {}
+    with ProcessPoolExecutor(max_workers=NO_OF_THREADS) as executor:
+        for repo_name, reason, repo_size in executor.map(checkRepoImports, repo_names, chunksize=16):
+            repo_sizes[repo_name] = repo_size
+            if reason is not None:
+                skip_reasons[repo_name] = reason
+
+    skipped_df = pd.DataFrame(list(skip_reasons.items()), columns=["sanitized_repo_name", "reason"])
+    skipped_df.to_csv(SKIPPED_REPOS_PATH, index=False)
+
+    return ([repo_name for repo_name in repo_names if repo_name not in skip_reasons], repo_sizes)
+
+
+# Size of the python sources of a repo, used to start the big repos first
+def getRepoSize(repo_name):
+    repo_size = 0
+    for root, dirs, files in os.walk(REPO_DIR + repo_name):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        for filename in files:
+            if filename.endswith(".py"):
+                repo_size += getFileSize(os.path.join(root, filename))
+    return repo_size
+
+
+def getFileSize(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def log(message):
+    with print_lock:
+        print(message, flush=True)
+
+
+def processRepo(repo_name):
+    log(f"Creating python database: {repo_name}")
+    if not createDatabase(repo_name):
+        return repo_name
+    log(f"Running codeql queries: {repo_name}")
     runQueries(repo_name)
-    print(f"Done with repo: {repo_name}")
\ No newline at end of file
+    return repo_name
+
+
+def main():
+    global CODEQL_VERSION
+    CODEQL_VERSION = getCodeQLVersion()
+    if not compileQueries():
+        sys.exit(f"The queries in {QUERY_PATH} do not compile")
+
+    repos = pd.read_csv("repo-list.csv")
+    repo_names = repos["sanitized_repo_name"].tolist()
+
+    quarantined_repos = getQuarantinedRepos()
+    if quarantined_repos:
+        repo_names = [repo_name for repo_name in repo_names if repo_name not in quarantined_repos]
+        print(f"Skipped {len(quarantined_repos)} quarantined repos, see {QUARANTINE_PATH}")
+
+    if PREFILTER_IMPORTS:
+        no_of_repos = len(repo_names)
+        # The sizes are found on the same walk as the imports
+        repo_names, repo_sizes = prefilterRepos(repo_names)
+        print(f"Skipped {no_of_repos - len(repo_names)} of {no_of_repos} repos without database driver imports, see {SKIPPED_REPOS_PATH}")
+    else:
+        repo_sizes = {repo_name: getRepoSize(repo_name) for repo_name in repo_names}
+
+    # The big repos take the longest, so they start first and the small ones
+    # fill the gaps at the end
+    repo_names = sorted(repo_names, key=lambda repo_name: repo_sizes[repo_name], reverse=True)
+
+    print(f"Running {NO_OF_CONCURRENT_REPOS} repos at a time with {THREADS_PER_REPO} threads and {RAM_PER_REPO} MB RAM each")
+
+    with ThreadPoolExecutor(max_workers=NO_OF_CONCURRENT_REPOS) as executor:
+        futures = [executor.submit(processRepo, repo_name) for repo_name in repo_names]
+        for idx, future in enumerate(as_completed(futures)):
+            log(f"Done with repo: {future.result()} - ({str(idx + 1)}/{len(repo_names)})")
+
+
+if __name__ == "__main__":
+    main()
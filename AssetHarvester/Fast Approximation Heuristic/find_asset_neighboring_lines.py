@@ -6,81 +6,263 @@ import os, sys
 import shutil
 import re
 from tqdm import tqdm
-from pandarallel import pandarallel
 from urllib.parse import urlparse, parse_qs
 import string
 from difflib import SequenceMatcher
 import jellyfish
 from git import Repo
-import linecache
+import mmap
 import heapq
+import subprocess
+import time
+from collections import OrderedDict
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
 
 FILE_DIR = "AssetBench/Files"
+REPO_DIR = "AssetBench/Repos"
+# Read the file of each secret at its commit from the object database of its
+# repo, instead of from the files written to FILE_DIR
+READ_FROM_GIT = False
+# Number of decoded blobs kept in memory for each repo
+BLOB_CACHE_SIZE = 16
 IP_REGEX = r"\b(?:\d{1,3}\.){3}\d{1,3}\b"
-DNS_REGEX = r"\b[A-Za-z0-9][A-Za-z0-9-.]*\.\D{2,4}\b"
+# The patterns run over a whole window of lines, so a match must not go past
+# the end of its line
+DNS_REGEX = r"\b[A-Za-z0-9][A-Za-z0-9-.]*\.[^\d\r\n]{2,4}\b"
+IP_PATTERN = re.compile(IP_REGEX)
+DNS_PATTERN = re.compile(DNS_REGEX)
+# Number of lines around the secret line searched for an asset
+WINDOW_SIZE = 3
+# Number of worker processes and of shards of files given to them
+NO_OF_WORKERS = os.cpu_count()
+NO_OF_SHARDS = NO_OF_WORKERS * 4
+OUTPUT_COLUMNS = ["id", "secret", "db_type", "secret_label", "repo_name", "repo_identifier",
+                  "commit_id", "file_path", "start_line", "asset_value", "asset_line_no"]
 
-def isAssetPresent(line):
-    match = re.search(IP_REGEX, line)
-    if not match:
-        match = re.search(DNS_REGEX, line)
-    
-    if match:
-        asset_value = line[match.start():match.end()]
-        return (TRUE, asset_value) 
-    
-    return (False, None)
-    
 
-def find_one_asset(file_identifier, secret_line):
+# Find the asset of each line of a window. The IP pattern is preferred, and
+# only the first match of a line is kept.
+def findWindowAssets(lines, first_line_no):
+    line_offsets = []
+    offset = 0
+    for line in lines:
+        line_offsets.append(offset)
+        offset += len(line)
+    window = "".join(lines)
+
+    assets = {}
+    for pattern in (IP_PATTERN, DNS_PATTERN):
+        for match in pattern.finditer(window):
+            line_no = first_line_no + bisect_right(line_offsets, match.start()) - 1
+            if line_no not in assets:
+                assets[line_no] = match.group()
+
+    return assets
+
+
+# Lines of a memory mapped file or of a blob. The offsets of the line starts
+# are indexed once, so a line is read by slicing the content. As with
+# linecache, a line ends with a newline and a line out of the file is empty.
+class FileLines:
+    def __init__(self, content):
+        self.content = content
+        if not content:
+            self.line_starts = np.zeros(1, dtype=np.int64)
+            return
+
+        # The buffer of a map must be released before the map is closed
+        data = np.frombuffer(content, dtype=np.uint8)
+        newlines = np.flatnonzero(data == ord("\n")) + 1
+        del data
+
+        self.line_starts = np.concatenate(([0], newlines))
+        if self.line_starts[-1] != len(content):
+            self.line_starts = np.append(self.line_starts, len(content))
+
+    def getlines(self, first_line_no, last_line_no):
+        return [self.getline(line_no) for line_no in range(first_line_no, last_line_no + 1)]
+
+    def getline(self, line_no):
+        if line_no < 1 or line_no >= len(self.line_starts):
+            return ""
+
+        line = self.content[self.line_starts[line_no - 1]:self.line_starts[line_no]]
+        return line.decode("utf-8", errors="replace").rstrip("\r\n") + "\n"
+
+
+# Map a file for the time its lines are read. A missing or empty file has no
+# lines.
+@contextmanager
+def openFileLines(file_path):
+    try:
+        f = open(file_path, "rb")
+    except OSError:
+        yield FileLines(None)
+        return
+
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield FileLines(None)
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield FileLines(mm)
+
+
+# Reads the files of a repo at any commit through two long running git
+# cat-file processes. --batch-check gives the blob of a commit and path, so
+# a blob that is the same at many commits is only read and indexed once.
+class GitBlobReader:
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.blobs = OrderedDict()
+        self.check_process = None
+        self.batch_process = None
+
+    def __enter__(self):
+        if os.path.isdir(self.repo_path):
+            self.check_process = self.startCatFile("--batch-check")
+            self.batch_process = self.startCatFile("--batch")
+        return self
+
+    def __exit__(self, *exc_info):
+        for process in (self.check_process, self.batch_process):
+            if process:
+                process.stdin.close()
+                process.wait()
+
+    def startCatFile(self, mode):
+        return subprocess.Popen(["git", "-C", self.repo_path, "cat-file", mode],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    # Send an object name to a cat-file process and read its header line.
+    # Gives None if the object is missing or is not a blob.
+    def request(self, process, object_name):
+        process.stdin.write(object_name.encode("utf-8") + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().split()
+        if len(header) != 3 or header[1] != b"blob":
+            return None
+        return (header[0].decode("ascii"), int(header[2]))
+
+    def getFileLines(self, commit_id, file_path):
+        if not self.check_process:
+            return FileLines(None)
+
+        blob = self.request(self.check_process, f"{commit_id}:{file_path}")
+        if not blob:
+            return FileLines(None)
+
+        blob_id, size = blob
+        if blob_id in self.blobs:
+            self.blobs.move_to_end(blob_id)
+            return self.blobs[blob_id]
+
+        self.request(self.batch_process, blob_id)
+        content = self.batch_process.stdout.read(size + 1)[:size]
+
+        file_lines = FileLines(content)
+        self.blobs[blob_id] = file_lines
+        if len(self.blobs) > BLOB_CACHE_SIZE:
+            self.blobs.popitem(last=False)
+        return file_lines
+
+
+def find_one_asset(file_lines, secret_line):
     heap = []
 
-    base_line = linecache.getline(os.path.join(FILE_DIR, file_identifier), int(start_line))
-    base_line_no = start_line
+    base_line_no = int(secret_line)
+    first_line_no = base_line_no - WINDOW_SIZE
+    lines = file_lines.getlines(first_line_no, base_line_no + WINDOW_SIZE)
+    base_line = lines[WINDOW_SIZE]
     
-    for line_no in range(base_line_no - 3, base_line_no + 4): 
-        asset_line = linecache.getline(os.path.join(FILE_DIR, file_identifier), line_no)
-        is_asset, asset_value = isAssetPresent(asset_line)
-        if is_asset:  
-            similarity_score = jellyfish.jaro_similarity(base_line, asset_line)
-            if similarity_score < 0.5:
-                continue
-            diff = abs(base_line_no - line_no)
-            heapq.heappush(heap, (diff, -similarity_score, line_no, asset_value))
+    for line_no, asset_value in findWindowAssets(lines, first_line_no).items(): 
+        asset_line = lines[line_no - first_line_no]
+        similarity_score = jellyfish.jaro_similarity(base_line, asset_line)
+        if similarity_score < 0.5:
+            continue
+        diff = abs(base_line_no - line_no)
+        heapq.heappush(heap, (diff, -similarity_score, line_no, asset_value))
     
+    if not heap:
+        return (None, None)
+
     return (heap[0][2], heap[0][3])
 
 
+# Find the assets of the secrets of a shard of files. Each file is read once
+# for all its secrets and released before the next one.
+def findShardAssets(shard):
+    results = []
+    for file_identifier, secrets in shard:
+        with openFileLines(os.path.join(FILE_DIR, file_identifier)) as file_lines:
+            for index, start_line in secrets:
+                asset_line, found_asset = find_one_asset(file_lines, start_line)
+                results.append((index, found_asset, asset_line))
+
+    return results
+
+
+# Find the assets of the secrets of a shard of repos, reading their files
+# from the object database of each repo
+def findRepoShardAssets(shard):
+    results = []
+    for repo_identifier, files in shard:
+        with GitBlobReader(os.path.join(REPO_DIR, repo_identifier)) as reader:
+            for commit_id, file_path, secrets in files:
+                file_lines = reader.getFileLines(commit_id, file_path)
+                for index, start_line in secrets:
+                    asset_line, found_asset = find_one_asset(file_lines, start_line)
+                    results.append((index, found_asset, asset_line))
+
+    return results
+
+
+def main():
+    # filter the secret-asset pairs where secret-asset present in same file and file_identifier is present
+    # and not being found by previous rules
+    data_df = pd.read_csv("secrets.csv")
+    already_found_assets = pd.read_csv("secret_asset_found.csv")
+    # The files are not needed when they are read from the repos
+    has_file = data_df["file_identifier"].notnull() if not READ_FROM_GIT else True
+    filtered_data_df = data_df[(data_df["in_same_file"] == 'Y') & has_file &
+                                         ~(data_df["id"].isin(already_found_assets["id"]))]
+
+    if READ_FROM_GIT:
+        # The files of a repo are read in one worker, grouped by commit
+        groups = []
+        for repo_identifier, repo_df in filtered_data_df.groupby("repo_identifier", sort=False):
+            files = [(commit_id, file_path, list(zip(file_df.index, file_df["start_line"])))
+                     for (commit_id, file_path), file_df in repo_df.groupby(["commit_id", "file_path"], sort=False)]
+            groups.append((repo_identifier, files))
+        find_assets = findRepoShardAssets
+    else:
+        groups = [(file_identifier, list(zip(file_df.index, file_df["start_line"])))
+                  for file_identifier, file_df in filtered_data_df.groupby("file_identifier", sort=False)]
+        find_assets = findShardAssets
+    shards = [groups[i::NO_OF_SHARDS] for i in range(NO_OF_SHARDS)]
+
+    start_time = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=NO_OF_WORKERS) as executor:
+        for shard_results in tqdm(executor.map(find_assets, shards), total=len(shards)):
+            results.extend(shard_results)
+    elapsed = time.perf_counter() - start_time
+
+    # Keep the rows in the order of secrets.csv
+    assets_df = pd.DataFrame(results, columns=["index", "asset_value", "asset_line_no"]).set_index("index")
+    assets_with_range_line_df = filtered_data_df.join(assets_df)[OUTPUT_COLUMNS]
+    # The secrets without an asset have no line number, which would make the
+    # line numbers floats
+    assets_with_range_line_df["asset_line_no"] = assets_with_range_line_df["asset_line_no"].astype("Int64")
+    assets_with_range_line_df.to_csv("assets_with_range_line.csv", index = False)
+
+    print(f"No of Secrets: {len(filtered_data_df)}")
+    print(f"Secrets/sec: {len(filtered_data_df) / elapsed:,.1f}")
+
 
-# filter the secret-asset pairs where secret-asset present in same file and file_identifier is present
-# and not being found by previous rules
-data_df = pd.read_csv("secrets.csv")
-already_found_assets = pd.read_csv("secret_asset_found.csv")
-filtered_data_df = data_df[(data_df["in_same_file"] == 'Y') & 
-                                     ~(data_df["file_identifier"].isnull())]
-already_found_asset_row_ids = already_found_assets["id"].tolist()
-
-assets_with_range_line = []
-
-
-for index, row in filtered_data_df.iterrows():
-    # if commit id is not present.
-    if row["id"] in already_found_asset_row_ids:
-        continue
-  
-    asset_line, found_asset = find_one_asset(row["file_identifier"], row["start_line"])
-    curr = {"id": row["id"],
-            "secret": row["secret"],
-            "db_type": row["db_type"],
-            "secret_label": row["secret_label"],
-            "repo_name": row["repo_name"],
-            "repo_identifier": row["repo_identifier"],
-            "commit_id": row["commit_id"],
-            "file_path": row["file_path"],
-            "start_line": row["start_line"],
-            "asset_value": found_asset,
-            "asset_line_no": asset_line}
-    assets_with_range_line.append(curr) 
-        
-assets_with_range_line_df = pd.DataFrame(assets_with_range_line)      
-assets_with_range_line_df.to_csv("assets_with_range_line.csv", index = False)  
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,22 @@ import numpy as np
 import pandas as pd
 import os, sys
 import shutil
+import signal
+import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+REPO_DIR = "Repos/"
+REPORT_DIR = "Reports/"
+# Number of repos scanned at the same time
+NO_OF_CONCURRENT_REPOS = os.cpu_count()
+# Seconds a tool may run on a repo before it is killed
+TOOL_TIMEOUTS = {"trufflehog": 60 * 60, "gitleaks": 60 * 60}
+# Number of times a failed tool is run again. A timed out tool is not, as it
+# would most likely hang again.
+NO_OF_RETRIES = 2
+REPORT_SUFFIXES = {"trufflehog": "_TH_V3_report.json", "gitleaks": "_gitLeaks_report.json"}
 
 
 def progress(count, total, status=''):
@@ -16,59 +31,109 @@ def progress(count, total, status=''):
     sys.stdout.write("[%s] %s%%%s\r" % (bar, percents, status))
     sys.stdout.flush()
 
-def main():
-  
-    repo_list_df = pd.read_csv("repo_list.csv")
-    repos_to_be_scanned = repo_list_df["sanitized_repo_name"].tolist()
 
-    absolute_path = os.path.abspath('.')
+# Command of a tool. trufflehog writes its report to stdout. gitleaks exits
+# with 1 on leaks by default, which is also its exit code on errors, so it is
+# made to exit with 0 on leaks.
+def getToolCommand(tool, filename, report_path):
+    if tool == "trufflehog":
+        return ["trufflehog", "git", "--json", "--regex", "--entropy", "--no-update", "--no-verification",
+                "file://" + REPO_DIR + filename]
 
-    error_repos = []
-    num_repos = len(repos_to_be_scanned)
-    ind = 0
-    
-    for filename in repos_to_be_scanned:
-        progress(ind + 1, num_repos)
-        ind = ind + 1
-
-        print("Working with repo:", filename)
-
-        outputDirString = "Reports/" + filename
-        isFolderExist = os.path.exists(outputDirString)
-        if not isFolderExist:
-            os.system("mkdir " + outputDirString)
-        else:
-            continue     
-        
-        if filename == '.DS_Store':
-            continue
-        else:
+    return ["gitleaks", "detect", "-v", "--source=" + REPO_DIR + filename, "--report-path=" + report_path,
+            "--exit-code=0"]
+
+
+def removeFile(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+# Run a tool on a repo, with retries. The report is written next to its
+# final path and only moved there when the tool succeeds, so a report in
+# Reports/<repo>/ is always complete. Gives the reason of the failure, or
+# None on success.
+def runTool(filename, tool):
+    output_dir = REPORT_DIR + filename
+    report_path = os.path.join(output_dir, filename + REPORT_SUFFIXES[tool])
+    tmp_report_path = report_path + ".tmp"
+    log_path = os.path.join(output_dir, tool + ".log")
+
+    # Scanned by a previous run
+    if os.path.exists(report_path):
+        return None
+
+    cmd = getToolCommand(tool, filename, tmp_report_path)
+    for attempt in range(NO_OF_RETRIES + 1):
+        removeFile(tmp_report_path)
+
+        with open(log_path, "ab") as log_file:
+            stdout_file = open(tmp_report_path, "wb") if tool == "trufflehog" else log_file
+            try:
+                # The tool gets its own process group, so the git processes
+                # it starts are killed with it on a timeout
+                process = subprocess.Popen(cmd, stdout=stdout_file, stderr=log_file, start_new_session=True)
+            except OSError as e:
+                return f"could not run {tool}: {e}"
+            finally:
+                if stdout_file is not log_file:
+                    stdout_file.close()
 
             try:
+                exit_code = process.wait(timeout=TOOL_TIMEOUTS[tool])
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.wait()
+                removeFile(tmp_report_path)
+                return f"timed out after {TOOL_TIMEOUTS[tool]}s"
 
-                #Code to create repos and move trufflehog True Entropy json files to correct Reports Folder
-                
-                os.system("trufflehog git --json --regex --entropy --no-update --no-verification  file://Repos/" + filename +  " > " + filename + "_TH_V3_report.json")
-                jsonFile = filename + '_TH_V3_report.json'
-                os.system("mv " + jsonFile + " " + outputDirString)                
+        if exit_code == 0 and os.path.exists(tmp_report_path):
+            os.replace(tmp_report_path, report_path)
+            return None
 
-                #Code to run git leaks code on each repo and move gitleaks json file to correct Reports Folder
-                os.system("gitleaks detect -v --source=Repos/" + filename + " --report-path=" + filename + "_gitLeaks_report.json")
-                jsonFile = filename + '_gitLeaks_report.json'
-                os.system("mv " + jsonFile + " " + outputDirString)
+        print(f"{tool} failed with exit code {exit_code} on repo: {filename} (attempt {attempt + 1}/{NO_OF_RETRIES + 1}), see {log_path}")
 
-            except Exception as e:
-                print(e)
-                error_repos.append(filename)  
+    removeFile(tmp_report_path)
+    return f"exit code {exit_code}"
+
+
+# Run both tools on a repo. Gives the tools that failed with their reason.
+def scanRepo(filename):
+    os.makedirs(REPORT_DIR + filename, exist_ok=True)
+
+    errors = []
+    for tool in ["trufflehog", "gitleaks"]:
+        reason = runTool(filename, tool)
+        if reason:
+            errors.append((filename, tool, reason))
+
+    return errors
+
+
+def main():
+  
+    repo_list_df = pd.read_csv("repo_list.csv")
+    repos_to_be_scanned = [filename for filename in repo_list_df["sanitized_repo_name"].tolist() if filename != '.DS_Store']
+
+    error_repos = []
+    num_repos = len(repos_to_be_scanned)
+
+    with ThreadPoolExecutor(max_workers=NO_OF_CONCURRENT_REPOS) as executor:
+        futures = {executor.submit(scanRepo, filename): filename for filename in repos_to_be_scanned}
+        for ind, future in enumerate(as_completed(futures)):
+            progress(ind + 1, num_repos)
+            print("Done with repo:", futures[future])
+            error_repos.extend(future.result())
     
     if len(error_repos) > 0:
-        error_repos_df = pd.DataFrame(error_repos, columns=["sanitized_repo_name"]) 
+        error_repos_df = pd.DataFrame(error_repos, columns=["sanitized_repo_name", "tool", "reason"]) 
         error_repos_df.to_csv("error_repos.csv", index = False)              
             
     return
 
 
 if __name__ == '__main__':
-    main()
-
-
+    main()
\ No newline at end of file
@@ -0,0 +1,78 @@
+import subprocess
+import time
+import re
+from sys import *
+
+import pattern_match
+
+
+# The search before the combined pattern: run the rules one after another
+def legacy_search_pattern(line):
+    for idx, pattern in enumerate(pattern_match.RE_PATTERNS):
+        match = re.search(pattern, line)
+
+        if match:
+            return (match, pattern_match.TAG_LOOKUP[idx])
+
+    return (None, None)
+
+
+# Get the lines of the diffs in the history of a repository, as they are
+# given to search_pattern
+def read_diff_lines(repo_path, max_commits):
+    log_cmd = [
+        "git",
+        "-C",
+        repo_path,
+        "log",
+        "--all",
+        "-p",
+        "--unified=0",
+        "--ignore-all-space",
+        "--no-color",
+        "--format=",
+        f"--max-count={max_commits}",
+    ]
+    log = subprocess.run(log_cmd, capture_output=True, check=True).stdout
+    return log.decode("utf-8", errors="replace").splitlines()
+
+
+# Run a search function on all the lines and get the lines/sec
+def run_search(search, lines):
+    start_time = time.perf_counter()
+    results = [search(line) for line in lines]
+    elapsed = time.perf_counter() - start_time
+
+    return (results, len(lines) / elapsed)
+
+
+def main():
+    if len(argv) < 2:
+        print(f"Usage: python {argv[0]} <repo_path> [max_commits]")
+        exit(1)
+
+    repo_path = argv[1]
+    max_commits = int(argv[2]) if len(argv) > 2 else 10000
+
+    lines = read_diff_lines(repo_path, max_commits)
+    print(f"No of Lines: {len(lines)}")
+
+    legacy_results, legacy_speed = run_search(legacy_search_pattern, lines)
+    results, speed = run_search(pattern_match.search_pattern, lines)
+
+    # Both searches must find the same rule at the same place
+    mismatches = 0
+    for (legacy_match, legacy_rule), (match, rule) in zip(legacy_results, results):
+        legacy_span = legacy_match.span() if legacy_match else None
+        span = match.span() if match else None
+        if legacy_span != span or legacy_rule != rule:
+            mismatches += 1
+
+    print(f"No of Matches: {sum(1 for match, _ in results if match)}")
+    print(f"Mismatches: {mismatches}")
+    print(f"Before: {legacy_speed:,.0f} lines/sec")
+    print(f"After: {speed:,.0f} lines/sec ({speed / legacy_speed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
 from git import Repo
-from git import NULL_TREE
+from multiprocessing import Pool
+from functools import partial
+from contextlib import contextmanager
 from urllib.parse import urlparse, parse_qs
-import hashlib
+from collections import OrderedDict, Counter, namedtuple
 import re
 import os
+import json
+import shutil
+import signal
+import threading
+import ast
+import time
+import cProfile
 from sys import *
 import pandas as pd
 import csv
@@ -21,124 +30,565 @@ PATTERNS = list(RULES.keys())
 TAG_LOOKUP = list(RULES.values())
 RE_PATTERNS = [re.compile(pattern) for pattern in PATTERNS]
 
+# Literals (in lowercase) that are part of any match of a rule, for
+# rejecting the lines that can not match before running the regexes
+RULE_LITERALS = {
+    "Group1": ["://"],
+    "Group2": ["provider=", "driver="],
+    "Group3": ["://"],
+}
+
+
+# Combine the rules into one pattern where each rule is an alternative in
+# a group named after its rule id, so the rule of a match is the last
+# closed group. The named groups of the rules are removed, since a name
+# can not be repeated in one pattern.
+def _combine_patterns(patterns, tags):
+    alternatives = []
+    for pattern, tag in zip(patterns, tags):
+        pattern = pattern.replace("(?i)", "", 1)
+        pattern = re.sub(r"\(\?P<\w+>", "(?:", pattern)
+        alternatives.append(f"(?P<{tag}>{pattern})")
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+
+COMBINED_PATTERN = _combine_patterns(PATTERNS, TAG_LOOKUP)
+
+directory = "AssetBench/Repos/"
+
+# Number of worker processes (1 runs the scan serially)
+NO_OF_WORKERS = os.cpu_count()
+# The commit walk of a repository is split into ranges of this many commits
+COMMIT_CHUNK_SIZE = 20000
+
+# Only scan the commits that are new since the previous run, using the
+# branch heads saved in CHECKPOINT_DIR. Every scan saves them.
+INCREMENTAL_SCAN = False
+CHECKPOINT_DIR = "Checkpoints/"
+
+# Arguments of git log for the diff of each commit with its first parent.
+# Root commits are diffed with an empty tree, so that no commit will be
+# missed. Ignore possible submodules (they are independent from this repo).
+# The path prefixes are given, so that a diff.noprefix or diff.mnemonicPrefix
+# in the user config can not change the paths that _read_patch_path reads.
+GIT_LOG_DIFF_ARGS = [
+    "--patch",
+    "--root",
+    "--diff-merges=first-parent",
+    "--find-renames",
+    "--unified=0",
+    "--ignore-all-space",
+    "--ignore-submodules=all",
+    "--full-index",
+    "--no-color",
+    "--no-ext-diff",
+    "--src-prefix=a/",
+    "--dst-prefix=b/",
+    "--format=commit %H",
+]
+NULL_SHA = "0" * 40
+
+# Format of the outputs: "csv" (Outputs/<repo>.csv) or "parquet"
+# (Outputs/<repo>/part-<n>.parquet)
+OUTPUT_FORMAT = "csv"
+# Number of detections kept in memory before they are written
+OUTPUT_BATCH_SIZE = 10000
+
+# Limits of the regex matching, so that a pathological file can not stall
+# the scan of a repository. Lines longer than MAX_LINE_LENGTH are truncated
+# (or skipped if removed), patches bigger than MAX_PATCH_SIZE bytes or
+# with a mean line length over MINIFIED_LINE_LENGTH are skipped, and the
+# search in a line stops after LINE_TIME_BUDGET seconds (0 for no limit).
+MAX_LINE_LENGTH = 25000
+MAX_PATCH_SIZE = 10 * 1024 * 1024
+MINIFIED_LINE_LENGTH = 5000
+MINIFIED_FILE_SUFFIXES = (".min.js", ".min.css", ".js.map", ".css.map")
+LINE_TIME_BUDGET = 1.0
+
+# Counters of a repository scan: commits, diffs, bytes, lines and matches,
+# and the lines and patches skipped, truncated or stopped by the limits
+SCAN_COUNTERS = Counter()
+# Seconds spent in each stage of a repository scan: fetch, count, diff
+# (reading git log), decode, regex and write
+STAGE_TIMES = Counter()
+
+# Machine-readable report of the run, written next to Outputs/
+RUN_REPORT_PATH = "pattern_match_report.json"
+# Profile the run with "cprofile" (pattern_match.prof) or "pyinstrument"
+# (pattern_match_profile.html), or None. Only the main process is
+# profiled, so set NO_OF_WORKERS to 1 for a full profile.
+PROFILER = None
+
+# A secret-asset pair found in a diff. A tuple is much smaller than a dict
+# on repositories with millions of detections.
+Detection = namedtuple(
+    "Detection",
+    [
+        "commit_id",
+        "file_path",
+        "start_line",
+        "start_column",
+        "end_column",
+        "matched_part",
+        "dbtype",
+        "host",
+        "port",
+        "dbname",
+        "username",
+        "password",
+        "rule_id",
+    ],
+)
+
+# Columns of the output that hold text
+TEXT_COLUMNS = [
+    field
+    for field in Detection._fields
+    if field not in ("start_line", "start_column", "end_column")
+]
+
+# Regex results of already scanned diffs, keyed by the (old, new) blob SHAs
+# and whether the file is minified
+BLOB_CACHE_SIZE = 500000
+_BLOB_CACHE = OrderedDict()
+
+
+# Add the time spent in a block to a stage
+@contextmanager
+def _timed(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_TIMES[stage] += time.perf_counter() - start_time
+
+
+def _reset_stats():
+    SCAN_COUNTERS.clear()
+    STAGE_TIMES.clear()
 
-# Scan a repository 
-def _scan(repo, since_timestamp, max_depth):
-    already_searched = set()
-    discoveries = []
 
+# Report of the counters and stage times of the current repository
+def _repo_report(wall_seconds=None):
+    report = {
+        "counters": dict(SCAN_COUNTERS),
+        "seconds": {stage: round(seconds, 3) for stage, seconds in STAGE_TIMES.items()},
+    }
+    if wall_seconds is not None:
+        report["wall_seconds"] = round(wall_seconds, 3)
+    return report
+
+
+# Write the run report with the totals and the report of each repository
+def _write_run_report(repo_reports, wall_seconds):
+    counters = Counter()
+    seconds = Counter()
+    for repo_report in repo_reports.values():
+        counters.update(repo_report["counters"])
+        seconds.update(repo_report["seconds"])
+
+    run_report = {
+        "wall_seconds": round(wall_seconds, 3),
+        "workers": NO_OF_WORKERS,
+        "incremental": INCREMENTAL_SCAN,
+        "total": {
+            "counters": dict(counters),
+            "seconds": {stage: round(value, 3) for stage, value in seconds.items()},
+        },
+        "repos": repo_reports,
+    }
+    with open(RUN_REPORT_PATH, "w") as f:
+        json.dump(run_report, f, indent=2)
+
+    return run_report
+
+
+def _start_profiler():
+    if PROFILER == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if PROFILER == "pyinstrument":
+        # Optional dependency, only needed for this profiler
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    return None
+
+
+def _stop_profiler(profiler):
+    if PROFILER == "cprofile":
+        profiler.disable()
+        profiler.dump_stats("pattern_match.prof")
+    elif PROFILER == "pyinstrument":
+        profiler.stop()
+        with open("pattern_match_profile.html", "w") as f:
+            f.write(profiler.output_html())
+
+
+# Scan a repository and add the detections to the sink. If a checkpoint is
+# given, only the commits that are not reachable from it are scanned, and
+# it is updated with the scanned branch heads.
+def _scan(repo, since_timestamp, max_depth, sink, checkpoint=None):
+    with _timed("fetch"):
+        branch_heads = _fetch_branches(repo)
+    print("No of Branches:", len(branch_heads))
+    revs = _walk_revs(repo, branch_heads, checkpoint)
+
+    for detections in _scan_commits(repo, revs, since_timestamp, max_depth):
+        sink.add(detections)
+    print(f"\n")
+
+    if checkpoint is not None:
+        checkpoint.update(branch_heads)
+
+
+# Fetch the remote branches and get the commit SHA of each branch head
+def _fetch_branches(repo):
     branches = repo.remotes.origin.fetch()
-    print("No of Branches:", len(branches))
-    branch_counter = 0
-
-    for remote_branch in branches:
-        branch_name = remote_branch.name
-        branch_counter += 1
-        print(
-            f"Working with Branch: {branch_name} ({str(branch_counter)} / {str(len(branches))})"
-        )
-        prev_commit = None
+    return {remote_branch.name: remote_branch.commit.hexsha for remote_branch in branches}
+
+
+# Revisions of the commit walk: all the branches, excluding the commits
+# already scanned in a previous run
+def _walk_revs(repo, branch_heads, checkpoint):
+    revs = list(branch_heads)
+    if checkpoint:
+        for commit_sha in set(checkpoint.values()):
+            # The commit can be gone after a force push and a gc
+            if repo.is_valid_object(commit_sha, "commit"):
+                revs.append("^" + commit_sha)
+    return revs
 
-        no_of_commits = len(list(repo.iter_commits(branch_name, max_count=max_depth)))
-        commit_counter = 0
 
-        # Note that the iteration of the commits is backwards, so the
-        # prev_commit is newer than curr_commit
-        for curr_commit in repo.iter_commits(branch_name, max_count=max_depth):
-            commit_counter += 1
+# Load the branch heads scanned in the previous run of a repository and the
+# size of its output at the end of that run. A checkpoint that does not
+# match the output (an older version, another output format, or an output
+# that was written again since) is ignored, so the repository is scanned
+# again from the start.
+def _load_checkpoint(repo_name):
+    checkpoint_path = CHECKPOINT_DIR + repo_name + ".json"
+    if not os.path.exists(checkpoint_path):
+        return ({}, None)
+
+    with open(checkpoint_path, "r") as f:
+        checkpoint = json.load(f)
+
+    if (
+        checkpoint.get("output_format") != OUTPUT_FORMAT
+        or not _output_has_size(repo_name, checkpoint["output_size"])
+    ):
+        print(f"The checkpoint of {repo_name} does not match its output, scanning it from the start")
+        return ({}, None)
+    return (checkpoint["branch_heads"], checkpoint["output_size"])
+
+
+# Save the scanned branch heads of a repository with the format and size of
+# its output. The file is replaced atomically so that a crash can not leave
+# a broken checkpoint.
+def _save_checkpoint(repo_name, branch_heads, output_size):
+    if not os.path.exists(CHECKPOINT_DIR):
+        os.makedirs(CHECKPOINT_DIR)
+
+    checkpoint = {
+        "branch_heads": branch_heads,
+        "output_format": OUTPUT_FORMAT,
+        "output_size": output_size,
+    }
+    checkpoint_path = CHECKPOINT_DIR + repo_name + ".json"
+    with open(checkpoint_path + ".tmp", "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+def _remove_checkpoint(repo_name):
+    checkpoint_path = CHECKPOINT_DIR + repo_name + ".json"
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+# Whether the output of a repository can be cut back to output_size: it has
+# at least that many Parquet parts, or the CSV is at least that long and
+# the size ends at the end of a row
+def _output_has_size(repo_name, output_size):
+    if OUTPUT_FORMAT == "parquet":
+        output_dir = "Outputs/" + repo_name
+        no_of_parts = len(os.listdir(output_dir)) if os.path.exists(output_dir) else 0
+        return no_of_parts >= output_size
+
+    if output_size == 0:
+        return True
+    output_path = "Outputs/" + repo_name + ".csv"
+    if not os.path.exists(output_path) or os.path.getsize(output_path) < output_size:
+        return False
+    with open(output_path, "rb") as f:
+        f.seek(output_size - 1)
+        return f.read(1) == b"\n"
+
+
+# Arguments of the commit walk for only keeping the commits newer than
+# since_timestamp
+def _rev_list_args(since_timestamp):
+    if since_timestamp == 0:
+        return {}
+    return {"max_age": since_timestamp + 1}
+
+
+# Walk the commit graph of the revisions (all the branches), so that every
+# commit is visited exactly once, and diff each commit with its first
+# parent. Yields the detections of each commit. The walk can be restricted
+# to a range of commits with skip and max_count.
+def _scan_commits(
+    repo, revs, since_timestamp, max_count, skip=0, show_progress=True
+):
+    rev_args = _rev_list_args(since_timestamp)
+
+    if show_progress:
+        with _timed("count"):
+            no_of_commits = int(
+                repo.git.rev_list(
+                    "--count", revs, max_count=max_count, skip=skip, **rev_args
+                )
+            )
+    commit_counter = 0
+
+    # All the diffs are read from one git log process instead of one
+    # process per commit
+    log_process = repo.git.log(
+        revs,
+        *GIT_LOG_DIFF_ARGS,
+        "--",
+        max_count=max_count,
+        skip=skip,
+        as_process=True,
+        **rev_args,
+    )
+
+    # The time spent waiting for the next commit is the diff stage
+    start_time = time.perf_counter()
+    for commit_hash, files in _read_commit_diffs(log_process.stdout):
+        STAGE_TIMES["diff"] += time.perf_counter() - start_time
+        SCAN_COUNTERS["commits"] += 1
+
+        commit_counter += 1
+        if show_progress:
             stdout.write(
                 f"\rCommit in Progress: {str(commit_counter)}/{str(no_of_commits)}"
             )
             stdout.flush()
-            # if not prev_commit, then curr_commit is the newest commit
-            # (and we have nothing to diff with).
-            # But we will diff the first commit with NULL_TREE here to
-            # check the oldest code. In this way, no commit will be missed.
-            if not prev_commit:
-                # The current commit is the latest one
-                prev_commit = curr_commit
-                continue
 
-            if prev_commit.committed_date <= since_timestamp:
-                # We have reached the (chosen) oldest timestamp, so
-                # continue with another branch
-                break
-
-            # This is useful for git merge: in case of a merge, we have the
-            # same commits (prev and current) in two different branches.
-            # This trick avoids scanning twice the same commits
-            diff_hash = hashlib.md5(
-                (str(prev_commit) + str(curr_commit)).encode("utf-8")
-            ).digest()
-            if diff_hash in already_searched:
-                prev_commit = curr_commit
-                continue
-            else:
-                # Avoid searching the same diffs
-                already_searched.add(diff_hash)
-
-            # Get the diff between two commits
-            # Ignore possible submodules (they are independent from
-            # this repo)
-            diff = curr_commit.diff(
-                prev_commit,
-                create_patch=True,
-                ignore_submodules="all",
-                ignore_all_space=True,
-                unified=0,
-                diff_filter="AM",
-            )
+        yield _diff_worker(files, commit_hash)
+        start_time = time.perf_counter()
 
-            # Diff between the current commit and the previous one
-            discoveries.extend(_diff_worker(diff, prev_commit))
-
-            prev_commit = curr_commit
-
-        # Handling the first commit (either from since_timestamp or the
-        # oldest).
-        # If `since_timestamp` is set, then there is no need to scan it
-        # (because we have already scanned this diff at the previous step).
-        # If `since_timestamp` is 0, we have reached the first commit of
-        # the repo, and the diff here must be calculated with an empty tree
-        if since_timestamp == 0:
-            diff = curr_commit.diff(
-                NULL_TREE,
-                create_patch=True,
-                ignore_submodules="all",
-                ignore_all_space=True,
-            )
+    log_process.wait()
+    STAGE_TIMES["diff"] += time.perf_counter() - start_time
 
-            discoveries = discoveries + _diff_worker(diff, prev_commit)
-        print(f"\n")
-    return discoveries
 
+# Get the path of a file from a '+++ b/<path>' line of a patch
+def _read_patch_path(line):
+    file_path = line[4:].rstrip(b"\n")
+    if file_path.endswith(b"\t"):
+        # A tab is added after the paths with spaces
+        file_path = file_path[:-1]
+    if file_path.startswith(b'"'):
+        # Paths with special characters are quoted like C strings
+        file_path = ast.literal_eval("b" + file_path.decode("ascii"))
+    return file_path[2:].decode("utf-8", errors="replace")
 
-# Worker for computing the diff between two commits
-def _diff_worker(diff, commit):
-    detections = []
-    for blob in diff:
-        # new file: a_path is None, deleted file: b_path is None
-        old_path = blob.b_path if blob.b_path else blob.a_path
 
-        printable_diff = blob.diff.decode("utf-8", errors="replace")
+# Parse the output of git log one line at a time. Yields the hash of each
+# commit and its changed files as (file_path, blob_key, patch), where the
+# patch is None for binary files. Deleted and renamed files are dropped,
+# same as the 'AM' diff filter.
+def _read_commit_diffs(stream):
+    commit_hash = None
+    files = []
+    blob_key = file_path = patch = None
+    in_hunks = skip_file = False
+
+    for line in stream:
+        if line.startswith(b"commit "):
+            if file_path is not None and not skip_file:
+                files.append((file_path, blob_key, patch))
+            if commit_hash is not None:
+                yield (commit_hash, files)
+
+            commit_hash = line[7:].strip().decode("ascii")
+            files = []
+            file_path = None
+        elif line.startswith(b"diff --git "):
+            if file_path is not None and not skip_file:
+                files.append((file_path, blob_key, patch))
 
-        if printable_diff.startswith("Binary files"):
+            blob_key = file_path = None
+            patch = []
+            in_hunks = skip_file = False
+        elif in_hunks:
+            # Skip the empty line between two commits
+            if line[:1] in b"@+- \\":
+                patch.append(line)
+        elif patch is None:
+            # Lines before the first diff of a commit
+            continue
+        elif line.startswith(b"@@"):
+            in_hunks = True
+            patch.append(line)
+        elif line.startswith(b"index "):
+            old_sha, new_sha = line.split()[1].decode("ascii").split("..")
+            blob_key = (
+                None if old_sha == NULL_SHA else old_sha,
+                None if new_sha == NULL_SHA else new_sha,
+            )
+        elif line.startswith((b"deleted file mode", b"rename from")):
+            skip_file = True
+        elif line.startswith(b"+++ "):
+            file_path = _read_patch_path(line)
+        elif line.startswith(b"Binary files"):
             # Do not scan binary files
+            file_path = line.rsplit(b" and ", 1)[1][:-len(b" differ\n")]
+            file_path = _read_patch_path(b"+++ " + file_path + b"\n")
+            patch = None
+
+    if file_path is not None and not skip_file:
+        files.append((file_path, blob_key, patch))
+    if commit_hash is not None:
+        yield (commit_hash, files)
+
+
+# Worker for scanning the changed files of a commit
+def _diff_worker(files, commit_hash):
+    detections = []
+    for file_path, blob_key, patch in files:
+        SCAN_COUNTERS["diffs"] += 1
+
+        # The same change of content (same old and new blobs) is only
+        # scanned once, even if it is in several commits or branches. The
+        # result also depends on whether the path is of a minified file,
+        # which _skip_patch does not scan.
+        cache_key = (blob_key, file_path.endswith(MINIFIED_FILE_SUFFIXES))
+        cached = _BLOB_CACHE.get(cache_key)
+        if cached is not None:
+            SCAN_COUNTERS["cached_diffs"] += 1
+            _BLOB_CACHE.move_to_end(cache_key)
+            detections.extend(
+                entry._replace(commit_id=commit_hash, file_path=file_path)
+                for entry in cached
+            )
             continue
 
-        detections = detections + _regex_check(printable_diff, old_path, commit.hexsha)
+        if patch is None or _skip_patch(file_path, patch):
+            result = ()
+        else:
+            with _timed("decode"):
+                printable_diff = b"".join(patch).decode("utf-8", errors="replace")
+            # Most of the diffs have no detections, and they all share the
+            # same empty tuple in the cache
+            with _timed("regex"):
+                result = tuple(_regex_check(printable_diff, file_path, commit_hash))
+
+        _BLOB_CACHE[cache_key] = result
+        if len(_BLOB_CACHE) > BLOB_CACHE_SIZE:
+            _BLOB_CACHE.popitem(last=False)
+
+        detections.extend(result)
+
+    # Counted here so that the detections replayed from the cache are in
+    SCAN_COUNTERS["matches"] += len(detections)
     return detections
 
 
+# Check the size and the shape of a patch before decoding it, so that huge
+# or minified files (e.g. vendored bundles) are not scanned
+def _skip_patch(file_path, patch):
+    if not patch:
+        return False
+
+    patch_size = sum(len(line) for line in patch)
+    SCAN_COUNTERS["bytes"] += patch_size
+    if patch_size > MAX_PATCH_SIZE:
+        SCAN_COUNTERS["skipped_patches"] += 1
+        return True
+
+    if (
+        file_path.endswith(MINIFIED_FILE_SUFFIXES)
+        or patch_size / len(patch) > MINIFIED_LINE_LENGTH
+    ):
+        SCAN_COUNTERS["minified_patches"] += 1
+        return True
+
+    return False
+
+
+def _raise_line_timeout(signum, frame):
+    raise LineTimeout()
+
+
+class LineTimeout(Exception):
+    pass
+
+
+# Search the patterns in a line within LINE_TIME_BUDGET seconds. The regex
+# engine checks for signals while matching, so an alarm can stop it. This
+# only works in the main thread, where the signal handlers run.
+def _search_line(row):
+    if (
+        not LINE_TIME_BUDGET
+        or not _has_rule_literal(row)
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        return search_pattern(row)
+
+    if signal.getsignal(signal.SIGALRM) is not _raise_line_timeout:
+        signal.signal(signal.SIGALRM, _raise_line_timeout)
+
+    try:
+        signal.setitimer(signal.ITIMER_REAL, LINE_TIME_BUDGET)
+        try:
+            return search_pattern(row)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except LineTimeout:
+        SCAN_COUNTERS["timed_out_lines"] += 1
+        return (None, None)
+
+
+# Check whether a line has a literal of any rule. Only ASCII lines can be
+# rejected, since case-insensitive regexes also match a few non-ASCII
+# letters (e.g. 'ı' for 'i').
+def _has_rule_literal(line):
+    if not line.isascii():
+        return True
+
+    line = line.lower()
+    for literals in RULE_LITERALS.values():
+        for literal in literals:
+            if literal in line:
+                return True
+    return False
+
+
 # Search for with pattern is matched
 def search_pattern(line):
-    for idx, pattern in enumerate(RE_PATTERNS):
-        match = re.search(pattern, line)
+    if not _has_rule_literal(line):
+        return (None, None)
+
+    match = COMBINED_PATTERN.search(line)
+    if not match:
+        return (None, None)
+
+    idx = TAG_LOOKUP.index(match.lastgroup)
 
-        if match:
-            return (match, TAG_LOOKUP[idx])
+    # The rules are checked in order, so a previous rule which matches
+    # further in the line still wins. It can not match before this match.
+    for prev_idx in range(idx):
+        prev_match = RE_PATTERNS[prev_idx].search(line, match.start() + 1)
+        if prev_match:
+            return (prev_match, TAG_LOOKUP[prev_idx])
 
-    return (None, None)
+    # Match the rule again for getting its named groups
+    return (RE_PATTERNS[idx].match(line, match.start()), TAG_LOOKUP[idx])
 
 
 # Find the db types
@@ -237,21 +687,21 @@ def create_match_entry(line, match_info, file_name, line_number, commit_hash, ru
         match_info, matched_part, rule_id
     )
 
-    entry = {
-        "commit_id": commit_hash,
-        "file_path": file_name,
-        "start_line": line_number,
-        "start_column": match_info.start(),
-        "end_column": match_info.end(),
-        "matched_part": matched_part,
-        "dbtype": dbtype,
-        "host": host,
-        "port": port,
-        "dbname": dbname,
-        "username": username,
-        "password": password,
-        "rule_id": rule_id,
-    }
+    entry = Detection(
+        commit_hash,
+        file_name,
+        line_number,
+        match_info.start(),
+        match_info.end(),
+        matched_part,
+        dbtype,
+        host,
+        port,
+        dbname,
+        username,
+        password,
+        rule_id,
+    )
 
     return entry
 
@@ -262,12 +712,18 @@ def _regex_check(printable_diff, filename, commit_hash):
     r_hunkheader = re.compile(r"@@\s*\-\d+(\,\d+)?\s\+(\d+)((\,\d+)?).*@@")
     r_hunkaddition = re.compile(r"^\+\s*(\S(.*\S)?)\s*$")
     rows = printable_diff.splitlines()
+    SCAN_COUNTERS["lines"] += len(rows)
     line_number = 1
     for row in rows:
-        if row.startswith("-") and len(row) > 25000:
-            # Take into consideration only added lines that are shorter
-            # than 500 characters
-            continue
+        if len(row) > MAX_LINE_LENGTH:
+            if row.startswith("-"):
+                # Long removed lines are not worth scanning
+                SCAN_COUNTERS["skipped_lines"] += 1
+                continue
+
+            # Only the start of long added lines is scanned
+            SCAN_COUNTERS["truncated_lines"] += 1
+            row = row[:MAX_LINE_LENGTH]
         if row.startswith("@@"):
             # If the row is a git diff hunk header, get the first addition
             # line number in the header and go to the next line
@@ -282,7 +738,7 @@ def _regex_check(printable_diff, filename, commit_hash):
                 row = r_groups.group(1)
 
         # Add the result if searched patterns are found in this line
-        matched, rule_id = search_pattern(row)
+        matched, rule_id = _search_line(row)
         if matched:
             try:
                 new_entry = create_match_entry(
@@ -297,33 +753,292 @@ def _regex_check(printable_diff, filename, commit_hash):
     return detections
 
 
-directory = "AssetBench/Repos/"
-repos = pd.read_csv("repo-list.csv")
-repo_name_dict = repos.set_index("sanitized_repo_name")["repo_name"].to_dict()
-filter_repos = repos[repos["status"] != "Done"]
-repo_names = filter_repos["sanitized_repo_name"].tolist()
+# Writes the detections of a repository in batches while they are found,
+# so they are not all kept in memory and a crash still leaves the results
+# written so far. With append, the detections are added to the ones of
+# the previous runs. The output is first cut back to the output_size saved
+# with the checkpoint, which drops the batches of a run that did not get to
+# save its checkpoint, as they are scanned again. Without append a new
+# output is written, and the checkpoint of the old one is removed.
+class DetectionSink:
+    def __init__(self, repo_name, repo_name_dict, append=False, output_size=None):
+        self.repo_name = repo_name
+        self.full_repo_name = repo_name_dict[repo_name]
+        self.append = append
+        self.batch = []
+
+        if append and output_size is not None:
+            self._truncate(output_size)
+        elif not append:
+            _remove_checkpoint(repo_name)
+
+    def add(self, detections):
+        self.batch.extend(detections)
+        if len(self.batch) >= OUTPUT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        df = pd.DataFrame(self.batch, columns=Detection._fields, dtype=object)
+        self.batch = []
+
+        # The text columns can be all None in a batch, and the port is an
+        # int, a string or None. They are all given the string type, so that
+        # every batch (and Parquet part) is written with the same types.
+        df[TEXT_COLUMNS] = df[TEXT_COLUMNS].astype("string")
+        df["repo_name"] = self.full_repo_name
+        df["sanitized_repo_name"] = self.repo_name
+        df["file_identifier"] = (
+            self.repo_name
+            + "_"
+            + df["commit_id"]
+            + "_"
+            + df["file_path"].str.replace("/", "-", regex=False)
+        )
 
+        with _timed("write"):
+            if OUTPUT_FORMAT == "parquet":
+                self._write_parquet(df)
+            else:
+                self._write_csv(df)
+
+        # The next batches go after this one
+        self.append = True
+
+    def close(self):
+        self.flush()
+
+    # Size of the output: the bytes of the CSV file or the number of Parquet
+    # part files
+    def output_size(self):
+        if OUTPUT_FORMAT == "parquet":
+            output_dir = "Outputs/" + self.repo_name
+            return len(os.listdir(output_dir)) if os.path.exists(output_dir) else 0
+
+        output_path = "Outputs/" + self.repo_name + ".csv"
+        return os.path.getsize(output_path) if os.path.exists(output_path) else 0
 
-# Run the regex in each repository
-for idx, repo_name in enumerate(repo_names):
-    print(f"Working with repo: {repo_name} - ({str(idx + 1)}/{len(repo_names)})")
+    def _truncate(self, output_size):
+        # Cutting the output anywhere else than at the end of a row would
+        # break it. _load_checkpoint has dropped such a checkpoint already.
+        if not _output_has_size(self.repo_name, output_size):
+            raise ValueError(f"The output of {self.repo_name} does not match its checkpoint")
+
+        if OUTPUT_FORMAT == "parquet":
+            output_dir = "Outputs/" + self.repo_name
+            if os.path.exists(output_dir):
+                for part_name in sorted(os.listdir(output_dir))[output_size:]:
+                    os.remove(os.path.join(output_dir, part_name))
+        else:
+            output_path = "Outputs/" + self.repo_name + ".csv"
+            if os.path.exists(output_path):
+                os.truncate(output_path, output_size)
+
+    def _write_csv(self, df):
+        output_path = "Outputs/" + self.repo_name + ".csv"
+        # An empty file has no header yet
+        if self.append and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            df.to_csv(output_path, mode="a", header=False, index=False)
+        else:
+            df.to_csv(output_path, index=False)
+
+    # Each batch is a part file in the output directory of the repository
+    def _write_parquet(self, df):
+        output_dir = "Outputs/" + self.repo_name
+        if not self.append and os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        part_no = len(os.listdir(output_dir))
+        df.to_parquet(
+            os.path.join(output_dir, f"part-{part_no:05d}.parquet"), index=False
+        )
+
+
+# Split the commit walk of each repository into tasks of
+# (repo_name, revs, skip, max_count, branch_heads, stage_times). The times
+# of fetching and counting the commits go with the first task of a
+# repository. A repository without commits to scan gets one empty task, so
+# it is finished and reported like the others.
+def _plan_tasks(repo_names, since_timestamp, max_depth):
+    for repo_name in repo_names:
+        start_time = time.perf_counter()
+        repo = Repo(directory + repo_name)
+        branch_heads = _fetch_branches(repo)
+        checkpoint = _load_checkpoint(repo_name)[0] if INCREMENTAL_SCAN else None
+        revs = _walk_revs(repo, branch_heads, checkpoint)
+        fetch_time = time.perf_counter() - start_time
+
+        no_of_commits = int(
+            repo.git.rev_list(
+                "--count",
+                revs,
+                max_count=max_depth,
+                **_rev_list_args(since_timestamp),
+            )
+        )
+        stage_times = {
+            "fetch": fetch_time,
+            "count": time.perf_counter() - start_time - fetch_time,
+        }
+
+        for skip in range(0, max(no_of_commits, 1), COMMIT_CHUNK_SIZE):
+            yield (
+                repo_name,
+                revs,
+                skip,
+                min(COMMIT_CHUNK_SIZE, no_of_commits - skip),
+                branch_heads,
+                stage_times if skip == 0 else {},
+            )
+
+
+# Worker for scanning one task in a separate process
+def _scan_task(task, since_timestamp):
+    repo_name, revs, skip, max_count, branch_heads, stage_times = task
     repo = Repo(directory + repo_name)
-    output = _scan(repo, 0, 2000000)
-    df = pd.DataFrame(output)
-
-    if df.empty:
-        continue
-
-    df["repo_name"] = repo_name_dict[repo_name]
-    df["sanitized_repo_name"] = repo_name
-    df["file_identifier"] = df[["sanitized_repo_name", "commit_id", "file_path"]].apply(
-        lambda x: x.sanitized_repo_name
-        + "_"
-        + x.commit_id
-        + "_"
-        + "-".join(x.file_path.split("/")),
-        axis=1,
+    _reset_stats()
+    STAGE_TIMES.update(stage_times)
+    detections = []
+    # git log would take a max count of 0 as no limit
+    if max_count == 0:
+        return (repo_name, branch_heads, detections, dict(SCAN_COUNTERS), dict(STAGE_TIMES))
+
+    for commit_detections in _scan_commits(
+        repo,
+        revs,
+        since_timestamp,
+        max_count,
+        skip=skip,
+        show_progress=False,
+    ):
+        detections.extend(commit_detections)
+    return (
+        repo_name,
+        branch_heads,
+        detections,
+        dict(SCAN_COUNTERS),
+        dict(STAGE_TIMES),
     )
-    df.to_csv("Outputs/" + repo_name + ".csv", index=False)
 
-print("Done........")
+
+# Write the rest of the output of a scanned repository, and its checkpoint.
+# A full scan has removed the old checkpoint when it started its output.
+def _finish_repo(sink, repo_name, branch_heads):
+    sink.close()
+
+    checkpoint = _load_checkpoint(repo_name)[0]
+    checkpoint.update(branch_heads)
+    _save_checkpoint(repo_name, checkpoint, sink.output_size())
+
+
+# Run the tasks in a pool of workers. The results come back in the task
+# order, so the outputs are the same as the serial scan. The counters and
+# stage times of the workers are added up for each repository. As the
+# repositories overlap, the wall time of a repository is from the end of
+# the one before it to its own end, so they add up to the time of the run.
+def _scan_parallel(repo_names, repo_name_dict, since_timestamp, max_depth):
+    tasks = _plan_tasks(repo_names, since_timestamp, max_depth)
+    worker = partial(_scan_task, since_timestamp=since_timestamp)
+
+    curr_repo_name = None
+    curr_branch_heads = None
+    sink = None
+    repo_reports = {}
+    start_time = time.perf_counter()
+
+    with Pool(NO_OF_WORKERS) as pool:
+        for repo_name, branch_heads, detections, counters, stage_times in pool.imap(
+            worker, tasks
+        ):
+            if repo_name != curr_repo_name:
+                if curr_repo_name is not None:
+                    _finish_repo(sink, curr_repo_name, curr_branch_heads)
+                    repo_reports[curr_repo_name] = _repo_report(time.perf_counter() - start_time)
+                    start_time = time.perf_counter()
+                    print(f"Done with repo: {curr_repo_name} - ({len(repo_reports)}/{len(repo_names)})")
+                curr_repo_name = repo_name
+                curr_branch_heads = branch_heads
+                # Only a repository with a checkpoint has an output to add to
+                checkpoint, output_size = (
+                    _load_checkpoint(repo_name) if INCREMENTAL_SCAN else ({}, None)
+                )
+                sink = DetectionSink(
+                    repo_name,
+                    repo_name_dict,
+                    append=bool(checkpoint),
+                    output_size=output_size,
+                )
+                _reset_stats()
+
+            SCAN_COUNTERS.update(counters)
+            STAGE_TIMES.update(stage_times)
+            sink.add(detections)
+
+    if curr_repo_name is not None:
+        _finish_repo(sink, curr_repo_name, curr_branch_heads)
+        repo_reports[curr_repo_name] = _repo_report(time.perf_counter() - start_time)
+        print(f"Done with repo: {curr_repo_name} - ({len(repo_reports)}/{len(repo_names)})")
+
+    return repo_reports
+
+
+# Scan the repositories one after another
+def _scan_serial(repo_names, repo_name_dict):
+    repo_reports = {}
+
+    # Run the regex in each repository
+    for idx, repo_name in enumerate(repo_names):
+        print(f"Working with repo: {repo_name} - ({str(idx + 1)}/{len(repo_names)})")
+        _reset_stats()
+        start_time = time.perf_counter()
+
+        repo = Repo(directory + repo_name)
+        checkpoint, output_size = (
+            _load_checkpoint(repo_name) if INCREMENTAL_SCAN else ({}, None)
+        )
+        # Only a repository with a checkpoint has an output to add to
+        sink = DetectionSink(
+            repo_name, repo_name_dict, append=bool(checkpoint), output_size=output_size
+        )
+        _scan(repo, 0, 2000000, sink, checkpoint)
+        sink.close()
+        _save_checkpoint(repo_name, checkpoint, sink.output_size())
+
+        repo_reports[repo_name] = _repo_report(time.perf_counter() - start_time)
+
+    return repo_reports
+
+
+def main():
+    repos = pd.read_csv("repo-list.csv")
+    repo_name_dict = repos.set_index("sanitized_repo_name")["repo_name"].to_dict()
+    if INCREMENTAL_SCAN:
+        # The checkpoints tell what is left to scan in each repository
+        repo_names = repos["sanitized_repo_name"].tolist()
+    else:
+        filter_repos = repos[repos["status"] != "Done"]
+        repo_names = filter_repos["sanitized_repo_name"].tolist()
+
+    profiler = _start_profiler()
+    start_time = time.perf_counter()
+
+    if NO_OF_WORKERS > 1:
+        repo_reports = _scan_parallel(repo_names, repo_name_dict, 0, 2000000)
+    else:
+        repo_reports = _scan_serial(repo_names, repo_name_dict)
+
+    run_report = _write_run_report(repo_reports, time.perf_counter() - start_time)
+    if profiler is not None:
+        _stop_profiler(profiler)
+
+    print("Counters:", run_report["total"]["counters"])
+    print("Seconds per stage:", run_report["total"]["seconds"])
+    print("Done........")
+
+
+if __name__ == "__main__":
+    main()